@@ -7,6 +7,9 @@ https://docs.djangoproject.com/en/dev/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/dev/ref/settings/
 """
+import os
+import tempfile
+
 import environ
 from .utils import process_key
 
@@ -297,8 +300,20 @@ SALESFORCE_ARTICLE_PREVIEW_URL_PATH_PREFIX = env(
 SALESFORCE_ARTICLE_TEXT_INDEX_FIELD = env(
     "SALESFORCE_ARTICLE_TEXT_INDEX_FIELD", default=""
 )
+# optional text field on the article storing a hash of its content; when set,
+# changes are detected by comparing hashes instead of downloading every body
+SALESFORCE_ARTICLE_HASH_FIELD = env("SALESFORCE_ARTICLE_HASH_FIELD", default="")
 SALESFORCE_ARTICLE_LINK_LIMIT = env("SALESFORCE_ARTICLE_LINK_LIMIT", default=100)
 SALESFORCE_API_VERSION = env("SALESFORCE_API_VERSION", default="41.0")
+# drafts written per batch of sObject Collections (API 42.0+) or Composite requests
+SALESFORCE_DRAFT_BATCH_SIZE = env.int("SALESFORCE_DRAFT_BATCH_SIZE", default=200)
+# share the cached Salesforce articles between workers through Redis (REDIS_URL)
+SALESFORCE_SHARED_CACHE = env.bool("SALESFORCE_SHARED_CACHE", default=False)
+# seconds shared articles are used without a SystemModstamp check, as long
+# as no worker wrote to the docset; 0 always checks
+SALESFORCE_SHARED_CACHE_CHECK_AFTER = env.int("SALESFORCE_SHARED_CACHE_CHECK_AFTER", default=0)
+# seconds before Redis drops shared articles that were not used
+SALESFORCE_SHARED_CACHE_TIMEOUT = env.int("SALESFORCE_SHARED_CACHE_TIMEOUT", default=24 * 60 * 60)
 SALESFORCE_COMMUNITY = env("SALESFORCE_COMMUNITY", default="powerofus")
 
 SALESFORCE_DOCSET_SOBJECT = env("SALESFORCE_DOCSET_SOBJECT", default="Hub_Product_Description__c")
@@ -314,3 +329,48 @@ CACHE_VALIDATION_MODE = env("CACHE_VALIDATION_MODE", default=False)
 # sometimes you need to re-publish unchanged articles because the 
 # publishing process itself has changed (e.g. new SF-side metadata)
 REPUBLISH_UNCHANGED_ARTICLES = env("REPUBLISH_UNCHANGED_ARTICLES", default=False)
+
+# parsed articles of a bundle are kept in memory between scrubbing and
+# uploading up to this many bytes of article HTML, then spilled to disk
+ARTICLE_STORE_MEMORY_BUDGET = env.int("ARTICLE_STORE_MEMORY_BUDGET", default=64 * 1024 * 1024)
+
+# number of processes used to scrub the HTML files of a bundle
+SCRUB_WORKERS = env.int("SCRUB_WORKERS", default=1)
+
+# scrubbing stops after this many problems in one article or one bundle
+SCRUB_PROBLEM_LIMIT = env.int("SCRUB_PROBLEM_LIMIT", default=100)
+
+# BeautifulSoup parser backend for article HTML: html.parser or lxml
+# (check with sfdoc.publish.html.compare_parsers before switching)
+HTML_PARSER = env("HTML_PARSER", default="html.parser")
+
+# easyDITA bundles are streamed to a spool file in chunks of this many bytes
+EASYDITA_DOWNLOAD_CHUNK_SIZE = env.int("EASYDITA_DOWNLOAD_CHUNK_SIZE", default=1024 * 1024)
+
+# interrupted easyDITA downloads are resumed this many times, waiting
+# BACKOFF seconds before the first retry and doubling up to BACKOFF_MAX
+EASYDITA_DOWNLOAD_RETRIES = env.int("EASYDITA_DOWNLOAD_RETRIES", default=5)
+EASYDITA_DOWNLOAD_BACKOFF = env.float("EASYDITA_DOWNLOAD_BACKOFF", default=1.0)
+EASYDITA_DOWNLOAD_BACKOFF_MAX = env.float("EASYDITA_DOWNLOAD_BACKOFF_MAX", default=60.0)
+EASYDITA_DOWNLOAD_TIMEOUT = env.float("EASYDITA_DOWNLOAD_TIMEOUT", default=60.0)
+
+# downloaded bundle zips are kept in BUNDLE_CACHE_DIR for requeues and
+# retries, up to BUNDLE_CACHE_SIZE bytes (0 disables the cache)
+BUNDLE_CACHE_DIR = env("BUNDLE_CACHE_DIR", default=os.path.join(tempfile.gettempdir(), "sfdoc-bundles"))
+BUNDLE_CACHE_SIZE = env.int("BUNDLE_CACHE_SIZE", default=1024 * 1024 * 1024)
+
+# "directory" unpacks each bundle into a temporary directory, "zip" reads
+# its files straight from the downloaded zip without extracting them
+BUNDLE_FILESYSTEM = env("BUNDLE_FILESYSTEM", default="directory")
+
+# number of threads unpacking the inner zips of a bundle
+UNZIP_WORKERS = env.int("UNZIP_WORKERS", default=min(4, os.cpu_count() or 1))
+
+# only process the files of a bundle that changed since the docset's last
+# published bundle (REPUBLISH_UNCHANGED_ARTICLES turns this off); unchanged
+# articles are still processed if their online version in Salesforce is not
+# the one sfdoc published as it wrote it, or they have a draft
+BUNDLE_DELTA_DETECTION = env.bool("BUNDLE_DELTA_DETECTION", default=False)
+
+# download and scrub a queued bundle while its docset has a bundle in review
+BUNDLE_PREFETCH = env.bool("BUNDLE_PREFETCH", default=False)
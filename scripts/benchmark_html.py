@@ -0,0 +1,222 @@
+"""Benchmark the HTML processing hot path.
+
+Times and measures the peak memory of parsing, scrubbing, collecting
+images, rewriting links to drafts and comparing with a Salesforce record,
+for the real bundles in testdata/bundles and for generated articles of
+growing size. Runs offline: no database, Salesforce, S3 or easyDITA.
+
+    python scripts/benchmark_html.py
+    python scripts/benchmark_html.py --save before.json
+    python scripts/benchmark_html.py --compare before.json
+
+Results saved with --save can be compared against later runs to catch
+regressions before they reach the workers.
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+sys.path.append(".")
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings.test")
+os.environ.setdefault("DATABASE_URL", "sqlite://:memory:")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.test import override_settings  # noqa: E402
+
+from sfdoc.publish import utils  # noqa: E402
+from sfdoc.publish.html import HTML, collect_html_paths  # noqa: E402
+from sfdoc.publish.models import AllowedLinkset  # noqa: E402
+
+rootdir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+logger = logging.getLogger("benchmark")
+
+# settings matching the meta tags of the easyDITA bundles in testdata
+BUNDLE_SETTINGS = {
+    "ARTICLE_AUTHOR": "ArticleOwner",
+    "ARTICLE_AUTHOR_OVERRIDE": "ArticleContributorOverride",
+    "ARTICLE_BODY_CLASS": "sfdo-kb__body",
+}
+ALLOWED_URLS = ["https://www.example.com/*", "https://*.salesforce.com/*"]
+GENERATED_SIZES = (10, 100, 1000)  # sections per generated article
+OPERATIONS = ("parse", "scrub", "get_image_paths", "update_links_draft", "same_as_record")
+
+
+def generate_article(path, sections):
+    """Write an article with links, images and tables and return its path."""
+    os.makedirs(os.path.join(path, "images"), exist_ok=True)
+    body = []
+    for n in range(sections):
+        image = f"images/image-{n}.png"
+        with open(os.path.join(path, image), "wb") as f:
+            f.write(b"\x89PNG")
+        body.append(
+            f'<h2>Section {n}</h2>'
+            f'<p>Some text with <a href="topics/article-{n}.html#part">a link</a> and '
+            f'<a href="https://www.example.com/page-{n}">an external link</a>.</p>'
+            f'<img src="../{image}"/>'
+            '<table><tr><th>Name</th><th>Value</th></tr>'
+            + ''.join(f'<tr><td>row {row}</td><td>{row * n}</td></tr>' for row in range(5))
+            + '</table>'
+        )
+    htmlpath = os.path.join(path, "topics", f"generated-{sections}.html")
+    os.makedirs(os.path.dirname(htmlpath), exist_ok=True)
+    with open(htmlpath, "w") as f:
+        f.write(f'''<html><head>
+<meta name="UrlName" content="generated-{sections}">
+<meta name="description" content="Generated article">
+<meta name="is-visible-in-csp" content="true">
+<meta name="is-visible-in-pkb" content="true">
+<meta name="is-visible-in-prm" content="true">
+<meta name="{settings.ARTICLE_AUTHOR}" content="author">
+<title>Generated article with {sections} sections</title>
+</head><body><div class="{settings.ARTICLE_BODY_CLASS}">{''.join(body)}</div></body></html>''')
+    return htmlpath
+
+
+def record_for(html):
+    """A Salesforce record identical to the published version of html."""
+    return {
+        settings.SALESFORCE_ARTICLE_AUTHOR_FIELD: html.author,
+        settings.SALESFORCE_ARTICLE_AUTHOR_OVERRIDE_FIELD: html.author_override,
+        "IsVisibleInCsp": html.is_visible_in_csp,
+        "IsVisibleInPkb": html.is_visible_in_pkb,
+        "IsVisibleInPrm": html.is_visible_in_prm,
+        "Title": html.title,
+        "Summary": html.summary,
+        settings.SALESFORCE_ARTICLE_BODY_FIELD: HTML.update_links_production(html.body),
+        settings.SALESFORCE_ARTICLE_HASH_FIELD: html.content_hash(),
+    }
+
+
+def measure(func, setup, repeat):
+    """Best time of repeat runs of func(setup()) and its peak memory."""
+    times = []
+    for _ in range(repeat):
+        arg = setup()
+        start = time.perf_counter()
+        func(arg)
+        times.append(time.perf_counter() - start)
+    arg = setup()
+    tracemalloc.start()
+    func(arg)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"seconds": min(times), "peak_bytes": peak}
+
+
+def benchmark_corpus(html_files, rootpath, repeat):
+    """Benchmark every operation over all articles of a corpus."""
+    html_files = sorted(html_files)
+    parsed = [HTML(html_file, rootpath) for html_file in html_files]
+    records = [record_for(html) for html in parsed]
+    image_urls = utils.draft_image_urls(
+        "benchmark-uuid",
+        rootpath,
+        {
+            os.path.abspath(os.path.join(os.path.dirname(html.htmlpath), src))
+            for html in parsed for src in html.get_image_paths()
+        },
+    )
+
+    def fresh():
+        return [HTML(html_file, rootpath) for html_file in html_files]
+
+    operations = {
+        "parse": (lambda _: fresh(), lambda: None),
+        "scrub": (lambda articles: [html.scrub() for html in articles], fresh),
+        "get_image_paths": (lambda articles: [html.get_image_paths() for html in articles], fresh),
+        "update_links_draft": (
+            lambda articles: [
+                html.update_links_draft("benchmark-uuid", "https://example.force.com", image_urls)
+                for html in articles
+            ],
+            fresh,
+        ),
+        "same_as_record": (
+            lambda articles: [
+                html.same_as_record(record, logger) for html, record in zip(articles, records)
+            ],
+            fresh,
+        ),
+    }
+    return {
+        "articles": len(html_files),
+        "bytes": sum(html.size for html in parsed),
+        "operations": {name: measure(func, setup, repeat) for name, (func, setup) in operations.items()},
+    }
+
+
+def run(repeat):
+    results = {}
+    with mock.patch.object(AllowedLinkset, "all_urls", return_value=ALLOWED_URLS):
+        utils.reset_url_matcher()
+        with override_settings(**BUNDLE_SETTINGS):
+            for zipfile in sorted(glob.glob(os.path.join(rootdir, "testdata/bundles/*.zip"))):
+                with TemporaryDirectory() as tempdir:
+                    utils.unzip(zipfile, tempdir, recursive=True, ignore_patterns=["*/assets/*"])
+                    path = utils.find_bundle_root_directory(tempdir)
+                    html_files = collect_html_paths(path, logger)
+                    name = "bundle " + os.path.splitext(os.path.basename(zipfile))[0]
+                    results[name] = benchmark_corpus(html_files, path, repeat)
+            for sections in GENERATED_SIZES:
+                with TemporaryDirectory() as tempdir:
+                    html_file = generate_article(tempdir, sections)
+                    results[f"generated {sections} sections"] = benchmark_corpus([html_file], tempdir, repeat)
+        utils.reset_url_matcher()
+    return results
+
+
+def report(results, baseline=None):
+    header = f"{'corpus':<45} {'operation':<20} {'ms':>10} {'peak KiB':>10}"
+    if baseline:
+        header += f" {'vs base':>8}"
+    print(header)
+    for corpus, result in results.items():
+        for operation in OPERATIONS:
+            measured = result["operations"][operation]
+            line = f"{corpus:<45} {operation:<20} {measured['seconds'] * 1000:>10.2f} " \
+                   f"{measured['peak_bytes'] / 1024:>10.0f}"
+            base = baseline and baseline.get(corpus, {}).get("operations", {}).get(operation)
+            if base and base["seconds"]:
+                line += f" {measured['seconds'] / base['seconds']:>7.2f}x"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="runs per operation; the best is reported")
+    parser.add_argument("--save", help="save the results as JSON to this file")
+    parser.add_argument("--compare", help="compare with results saved earlier with --save")
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    report(results, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "html_parser": settings.HTML_PARSER,
+                "repeat": args.repeat,
+                "results": results,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Benchmark unpacking nested bundle zips with and without worker threads.
+
+Unpacks testdata/matryoshka.zip, the bundles in testdata/bundles and
+generated wide bundles (many inner zips of many articles each) with
+utils.unzip, once serially and once per requested worker count.
+
+    python scripts/benchmark_unzip.py
+    python scripts/benchmark_unzip.py --workers 2 4 8 --inner 32 --files 200
+"""
+import argparse
+import glob
+import os
+import random
+import sys
+import time
+from tempfile import TemporaryDirectory
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+sys.path.append(".")
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings.test")
+os.environ.setdefault("DATABASE_URL", "sqlite://:memory:")
+
+import django  # noqa: E402
+
+django.setup()
+
+from sfdoc.publish import utils  # noqa: E402
+
+rootdir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+WORDS = "the quick brown fox jumps over lazy dog salesforce article body".split()
+
+
+def generate_bundle(zip_path, inner, files):
+    """Write an easyDITA-like zip of `inner` stored inner zips of `files` articles."""
+    rng = random.Random(inner * files)
+    with ZipFile(zip_path, "w", ZIP_STORED) as outer:
+        for n in range(inner):
+            inner_path = f"{zip_path}.{n}"
+            with ZipFile(inner_path, "w", ZIP_DEFLATED) as f:
+                f.writestr(f"Bundle{n}/log.txt", "log")
+                for m in range(files):
+                    text = " ".join(rng.choice(WORDS) for _ in range(4000))
+                    f.writestr(f"Bundle{n}/topics/article-{m}.html", f"<html><body><p>{text}</p></body></html>")
+                    f.writestr(f"Bundle{n}/assets/skipped-{m}.png", text)
+            outer.write(inner_path, f"Bundle{n}.zip")
+            os.remove(inner_path)
+
+
+def time_unzip(zip_path, workers, repeat):
+    times = []
+    for _ in range(repeat):
+        with TemporaryDirectory() as path:
+            start = time.perf_counter()
+            utils.unzip(zip_path, path, recursive=True, ignore_patterns=["*/assets/*"], workers=workers)
+            times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--inner", type=int, default=16, help="inner zips per generated bundle")
+    parser.add_argument("--files", type=int, default=100, help="articles per inner zip")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement; the best is reported")
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tempdir:
+        zips = [os.path.join(rootdir, "testdata/matryoshka.zip")]
+        zips += sorted(glob.glob(os.path.join(rootdir, "testdata/bundles/*.zip")))[:1]
+        for inner in sorted({4, args.inner}):
+            zip_path = os.path.join(tempdir, f"wide-{inner}x{args.files}.zip")
+            generate_bundle(zip_path, inner, args.files)
+            zips.append(zip_path)
+
+        print(f"{'zip':<45} {'MiB':>8} {'workers':>8} {'ms':>10} {'speedup':>8}")
+        for zip_path in zips:
+            size = os.path.getsize(zip_path) / 1024 / 1024
+            serial = time_unzip(zip_path, 1, args.repeat)
+            name = os.path.basename(zip_path)
+            print(f"{name:<45} {size:>8.1f} {1:>8} {serial * 1000:>10.1f} {1:>7.2f}x")
+            for workers in args.workers:
+                seconds = time_unzip(zip_path, workers, args.repeat)
+                print(f"{name:<45} {size:>8.1f} {workers:>8} {seconds * 1000:>10.1f} {serial / seconds:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 from django.contrib import admin
+from django.contrib import messages
 
 from .models import Article
 from .models import Bundle
@@ -6,6 +7,7 @@ from .models import Image
 from .models import Webhook
 from .models import Docset
 from .models import AllowedLinkset
+from .shared_cache import get_shared_article_cache
 from django.utils.html import format_html_join, mark_safe
 
 
@@ -55,6 +57,18 @@ class DocsetAdmin(admin.ModelAdmin):
         'docset_id',
         'display_name'
     ]
+    actions = ['clear_shared_article_cache']
+
+    def clear_shared_article_cache(self, request, queryset):
+        """Make all workers query the articles of the docsets again in full."""
+        shared = get_shared_article_cache()
+        if shared is None:
+            self.message_user(request, 'SALESFORCE_SHARED_CACHE is off', messages.WARNING)
+            return
+        for docset in queryset:
+            shared.invalidate(docset.docset_id)
+        self.message_user(request, f'Cleared the shared article cache of {len(queryset)} docsets')
+    clear_shared_article_cache.short_description = 'Clear shared Salesforce article cache'
 admin.site.register(Docset, DocsetAdmin)
 
 
@@ -1,4 +1,3 @@
-import filecmp
 import os
 from tempfile import TemporaryDirectory
 
@@ -7,6 +6,7 @@ import botocore
 from django.conf import settings
 from logging import getLogger
 
+from .bundlefs import local_fs
 from .models import Image
 from . import utils
 
@@ -81,7 +81,7 @@ class S3:
             else:
                 break
 
-    def process_image(self, filename, rootpath):
+    def process_image(self, filename, rootpath, fs=local_fs):
         """Upload image file to S3 if needed."""
         relative_filename = utils.bundle_relative_path(rootpath, filename)
         draft_key = Image.get_storage_path(self.docset_id, relative_filename, draft=True)
@@ -103,7 +103,7 @@ class S3:
                 if e.response['Error']['Code'] == '404':
                     # image does not exist on S3, create a new one
                     logger.info("Uploading: %s", prod_key)
-                    self.upload_image(filename, draft_key)
+                    self.upload_image(filename, draft_key, fs)
 
                     # Keep track of the fact that we need to transfer it to prod
                     Image.objects.create(
@@ -115,16 +115,16 @@ class S3:
                 else:
                     raise
             # image already in production; compare it to local image
-            if filecmp.cmp(filename, s3localname):
+            if _same_content(fs, filename, s3localname):
                 # files are the same, no update
                 logger.info("Images are the same: %s, %s", filename, s3localname)
-                self.upload_image(filename, draft_key)
+                self.upload_image(filename, draft_key, fs)
                 return
             else:
                 # files differ, update image
                 logger.info("Upload image: %s, %s", filename, draft_key)
 
-                self.upload_image(filename, draft_key)
+                self.upload_image(filename, draft_key, fs)
                 Image.objects.create(
                     bundle=self.bundle,
                     filename=relative_filename,
@@ -132,11 +132,23 @@ class S3:
                 )
                 return
 
-    def upload_image(self, filename, key):
-        with open(filename, 'rb') as f:
+    def upload_image(self, filename, key, fs=local_fs):
+        with fs.open(filename, 'rb') as f:
             self.api.meta.client.put_object(
                 ACL='public-read',
                 Body=f,
                 Bucket=settings.AWS_S3_BUCKET,
                 Key=key,
             )
+
+
+def _same_content(fs, filename, localname):
+    """Compare a bundle file with a file on local disk."""
+    with fs.open(filename, "rb") as f1, open(localname, "rb") as f2:
+        while True:
+            chunk1 = f1.read(64 * 1024)
+            chunk2 = f2.read(64 * 1024)
+            if chunk1 != chunk2:
+                return False
+            if not chunk1:
+                return True
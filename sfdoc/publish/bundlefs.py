@@ -0,0 +1,233 @@
+"""Read-only views of bundle files, on disk or inside the bundle zip.
+
+Code that reads bundle files takes an `fs` argument and calls fs.walk,
+fs.exists and fs.open where it would call os.walk, os.path.exists and
+open. DirectoryFS reads an unpacked bundle from disk; ZipFS reads members
+straight from the downloaded zip, so nothing has to be extracted.
+"""
+import fnmatch
+import io
+import os
+import struct
+from zipfile import ZIP_STORED, ZipFile
+
+# local file header: signature, versions, flags, method, times, crc,
+# sizes, then the lengths of the name and the extra field
+_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+
+
+class DirectoryFS:
+    """Bundle files in a directory on disk, addressed by real paths."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def walk(self, top):
+        return os.walk(top)
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def open(self, path, mode="rb"):
+        return open(path, mode)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+local_fs = DirectoryFS("/")
+
+
+class ZipFS:
+    """Bundle files read from a zip, addressed by paths under `root`.
+
+    Members are laid out as utils.unzip(recursive=True) would extract
+    them: an inner zip is a directory named after it, and members matching
+    ignore_patterns are left out at every level. Only the central
+    directories are kept in memory.
+
+    The zip is read with os.pread, so processes forked from the one that
+    opened it can use the same ZipFS at the same time: they share the file
+    descriptor but keep their own positions. The zip is not opened or
+    parsed again, and removing its file does not affect them.
+    """
+
+    def __init__(self, zip_path, root="/bundle", ignore_patterns=None):
+        self.zip_path = zip_path
+        self.root = root
+        self.ignore_patterns = ignore_patterns or []
+        self._file = _PreadFile(zip_path)
+        self._zipfiles = []
+        self._dirs = {root: ([], [])}
+        self._members = {}
+        try:
+            self._add_zip(self._file, root)
+        except BaseException:
+            self.close()
+            raise
+
+    def walk(self, top):
+        top = os.path.normpath(top)
+        if top not in self._dirs:
+            return
+        dirnames, filenames = self._dirs[top]
+        dirnames = sorted(dirnames)
+        yield top, dirnames, sorted(filenames)
+        for dirname in dirnames:
+            yield from self.walk(os.path.join(top, dirname))
+
+    def exists(self, path):
+        path = os.path.normpath(path)
+        return path in self._members or path in self._dirs
+
+    def open(self, path, mode="rb"):
+        try:
+            zipfile, info = self._members[os.path.normpath(path)]
+        except KeyError:
+            raise FileNotFoundError(path)
+        member = zipfile.open(info)
+        if "b" in mode:
+            return member
+        return io.TextIOWrapper(member)
+
+    def close(self):
+        for zipfile in self._zipfiles:
+            zipfile.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _add_zip(self, fileobj, path):
+        zipfile = ZipFile(fileobj)
+        self._zipfiles.append(zipfile)
+        for info in zipfile.infolist():
+            if any(fnmatch.fnmatch(info.filename, pattern) for pattern in self.ignore_patterns):
+                continue
+            name = info.filename.rstrip("/")
+            root, ext = os.path.splitext(name)
+            if info.is_dir():
+                self._add_dir(member_path(path, name))
+            elif ext.lower() == ".zip":
+                self._add_dir(member_path(path, root))
+                self._add_zip(_open_nested(fileobj, zipfile, info), member_path(path, root))
+            else:
+                filename = member_path(path, name)
+                self._add_dir(os.path.dirname(filename))
+                self._dirs[os.path.dirname(filename)][1].append(os.path.basename(filename))
+                self._members[filename] = (zipfile, info)
+
+    def _add_dir(self, path):
+        if path not in self._dirs:
+            self._dirs[path] = ([], [])
+            parent = os.path.dirname(path)
+            self._add_dir(parent)
+            self._dirs[parent][0].append(os.path.basename(path))
+
+
+def member_path(path, name):
+    """Join a zip member name to path the way ZipFile.extract does."""
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".", "..")]
+    return os.path.join(path, *parts)
+
+
+def _open_nested(fileobj, zipfile, info):
+    """A seekable file of the zip member info, which is itself a zip.
+
+    Stored members are read in place from the parent file, compressed
+    ones through the (much slower to seek) decompressing member stream.
+    """
+    if info.compress_type != ZIP_STORED:
+        return zipfile.open(info)
+    fileobj.seek(info.header_offset)
+    header = _LOCAL_HEADER.unpack(fileobj.read(_LOCAL_HEADER.size))
+    name_length, extra_length = header[-2:]
+    offset = info.header_offset + _LOCAL_HEADER.size + name_length + extra_length
+    return _Window(fileobj, offset, info.file_size)
+
+
+class _PreadFile(io.RawIOBase):
+    """A file read with os.pread at a position kept in memory."""
+
+    def __init__(self, path):
+        self._fd = os.open(path, os.O_RDONLY)
+        self._size = os.fstat(self._fd).st_size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self._size
+        if pos < 0:
+            raise ValueError(f"negative seek position {pos}")
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        data = os.pread(self._fd, len(b), self._pos)
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
+
+
+class _Window(io.RawIOBase):
+    """The size bytes of fileobj starting at offset, as a file."""
+
+    def __init__(self, fileobj, offset, size):
+        self._fileobj = fileobj
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self._size
+        if pos < 0:
+            raise ValueError(f"negative seek position {pos}")
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        count = max(0, min(len(b), self._size - self._pos))
+        if not count:
+            return 0
+        self._fileobj.seek(self._offset + self._pos)
+        data = self._fileobj.read(count)
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
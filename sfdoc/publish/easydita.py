@@ -0,0 +1,228 @@
+import base64
+import hashlib
+import os
+import re
+from tempfile import NamedTemporaryFile
+import time
+
+from django.conf import settings
+import requests
+
+from .exceptions import SfdocError
+
+# a dropped connection shows up as one of these, or as a short body
+RETRYABLE_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+class IncompleteDownload(SfdocError):
+    pass
+
+
+def download_bundle(url, zip_file, logger, auth=None):
+    """Download url into zip_file, resuming with Range requests on failure.
+
+    Interrupted downloads and server errors are retried up to
+    EASYDITA_DOWNLOAD_RETRIES times, waiting EASYDITA_DOWNLOAD_BACKOFF
+    seconds before the first retry and twice as long before each next one.
+    Returns the sha256 hex digest of the downloaded bytes.
+    """
+    download = _Download(url, zip_file, auth)
+    start = time.monotonic()
+    retries = 0
+    while True:
+        try:
+            download.fetch()
+            break
+        except RETRYABLE_ERRORS + (IncompleteDownload,) as e:
+            error = e
+        except requests.HTTPError as e:
+            if e.response.status_code < 500:
+                raise
+            error = e
+        retries += 1
+        if retries > settings.EASYDITA_DOWNLOAD_RETRIES:
+            raise SfdocError(
+                f"Download of {url} failed after {retries - 1} retries: {error}"
+            ) from error
+        delay = min(
+            settings.EASYDITA_DOWNLOAD_BACKOFF * 2 ** (retries - 1),
+            settings.EASYDITA_DOWNLOAD_BACKOFF_MAX,
+        )
+        logger.warning(
+            'Download interrupted after %d bytes (%s), retry %d of %d in %.1f seconds',
+            download.size, error, retries, settings.EASYDITA_DOWNLOAD_RETRIES, delay,
+        )
+        time.sleep(delay)
+    download.verify()
+
+    seconds = time.monotonic() - start
+    logger.info(
+        'Downloaded %d bytes in %.1f seconds (%.0f KB/s) with %d retries, sha256 %s',
+        download.size, seconds, download.size / 1024 / max(seconds, 0.001),
+        retries, download.sha256.hexdigest(),
+    )
+    return download.sha256.hexdigest()
+
+
+class _Download:
+    """State of one download, kept across the requests that resume it."""
+
+    def __init__(self, url, zip_file, auth):
+        self.url = url
+        self.zip_file = zip_file
+        self.auth = auth
+        self.start = zip_file.tell()
+        self.restart()
+
+    def restart(self):
+        self.zip_file.seek(self.start)
+        self.zip_file.truncate()
+        self.size = 0
+        self.length = None
+        self.md5 = None
+        self.sha256 = hashlib.sha256()
+        self.md5_received = hashlib.md5()
+
+    def fetch(self):
+        """Request the bytes not downloaded yet and append them."""
+        headers = {"Range": f"bytes={self.size}-"} if self.size else {}
+        with requests.get(
+            self.url,
+            auth=self.auth,
+            headers=headers,
+            stream=True,
+            timeout=settings.EASYDITA_DOWNLOAD_TIMEOUT,
+        ) as response:
+            response.raise_for_status()
+            if response.status_code == 206:
+                self._check_content_range(response.headers)
+            else:
+                # first request, or the server ignored the Range header
+                self.restart()
+                self._read_full_headers(response.headers)
+            for chunk in response.iter_content(chunk_size=settings.EASYDITA_DOWNLOAD_CHUNK_SIZE):
+                self.zip_file.write(chunk)
+                self.sha256.update(chunk)
+                self.md5_received.update(chunk)
+                self.size += len(chunk)
+        if self.length is not None and self.size < self.length:
+            raise IncompleteDownload(f"got {self.size} of {self.length} bytes")
+
+    def verify(self):
+        if self.length is not None and self.size != self.length:
+            raise SfdocError(f"Downloaded {self.size} of {self.length} bytes from {self.url}")
+        if self.md5 is not None and self.md5 != self.md5_received.digest():
+            raise SfdocError(f"Checksum mismatch for bundle downloaded from {self.url}")
+
+    def _read_full_headers(self, headers):
+        # Content-Length counts the encoded bytes, iter_content yields decoded ones
+        if "Content-Length" in headers and "Content-Encoding" not in headers:
+            self.length = int(headers["Content-Length"])
+        if "Content-MD5" in headers:
+            self.md5 = base64.b64decode(headers["Content-MD5"])
+
+    def _check_content_range(self, headers):
+        match = re.match(r"bytes (\d+)-\d+/(\d+|\*)", headers.get("Content-Range", ""))
+        if not match or int(match.group(1)) != self.size:
+            raise SfdocError(
+                f"Unexpected Content-Range {headers.get('Content-Range')!r} resuming {self.url}"
+            )
+        if match.group(2) != "*":
+            self.length = int(match.group(2))
+
+
+class BundleCache:
+    """Downloaded bundle zips on local disk, keyed by easyDITA output UUID.
+
+    Output UUIDs never change content, so requeued and retried bundles can
+    be unpacked from here. Each zip is stored as <uuid>-<sha256>.zip and
+    checked against its hash when opened. When the cache grows beyond
+    max_size bytes the least recently used zips are removed.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    def open(self, easydita_id):
+        """An open file of the cached zip for easydita_id, or None."""
+        for filename in self._filenames(easydita_id):
+            zip_path = os.path.join(self.path, filename)
+            try:
+                zip_file = open(zip_path, "rb")
+            except FileNotFoundError:
+                continue  # evicted by another worker
+            if _sha256(zip_file) == self._sha256_of(filename):
+                os.utime(zip_path)
+                zip_file.seek(0)
+                return zip_file
+            zip_file.close()
+            self._remove(zip_path)
+        return None
+
+    def add(self, easydita_id, download):
+        """Cache the zip written by download(zip_file), which returns its
+        sha256 hex digest, and return it as an open file."""
+        with NamedTemporaryFile(dir=self.path, suffix=".part", delete=False) as zip_file:
+            try:
+                sha256 = download(zip_file)
+            except BaseException:
+                self._remove(zip_file.name)
+                raise
+        zip_path = os.path.join(self.path, f"{easydita_id}-{sha256}.zip")
+        os.replace(zip_file.name, zip_path)
+        # open before evicting: an open file survives its removal
+        zip_file = open(zip_path, "rb")
+        self.evict()
+        return zip_file
+
+    def evict(self):
+        """Remove least recently used zips until the cache fits max_size."""
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".zip"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, zip_path in sorted(entries):
+            if size <= self.max_size:
+                break
+            self._remove(zip_path)
+            size -= entry_size
+
+    def _filenames(self, easydita_id):
+        pattern = re.compile(re.escape(easydita_id) + r"-[0-9a-f]{64}\.zip$")
+        return [filename for filename in os.listdir(self.path) if pattern.match(filename)]
+
+    @staticmethod
+    def _sha256_of(filename):
+        return os.path.splitext(filename)[0].rsplit("-", 1)[-1]
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def get_bundle_cache():
+    """The BundleCache from settings, or None if it is disabled."""
+    if not settings.BUNDLE_CACHE_SIZE:
+        return None
+    return BundleCache(settings.BUNDLE_CACHE_DIR, settings.BUNDLE_CACHE_SIZE)
+
+
+def _sha256(f):
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+        sha256.update(chunk)
+    return sha256.hexdigest()
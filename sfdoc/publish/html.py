@@ -1,9 +1,16 @@
+import hashlib
+from html.parser import HTMLParser
+import json
 import os
+import pickle
+from tempfile import TemporaryDirectory
 from urllib.parse import urlparse
 
 from bs4 import BeautifulSoup
+from bs4.element import Tag
 from django.conf import settings
 
+from .bundlefs import local_fs
 from .exceptions import HtmlError
 from .utils import is_html
 from .utils import is_url_whitelisted
@@ -12,30 +19,42 @@ from . import utils
 from sfdoc.publish.models import Image
 
 
+def article_meta_fields():
+    """Meta tags of an article as (Python attrname, HTML Name, Optional or not)."""
+    return (
+        ('url_name', 'UrlName', False),
+        ('summary', 'description', True),
+        ('is_visible_in_csp', 'is-visible-in-csp', False),
+        ('is_visible_in_pkb', 'is-visible-in-pkb', False),
+        ('is_visible_in_prm', 'is-visible-in-prm', False),
+        ('author', settings.ARTICLE_AUTHOR, False),
+        ('docset_id', 'ProductMapUUID', True),  # Should be required but will break a lot of tests,
+        ('Topics__c', "HubTopics", True),
+        ('Article_Type__c', "ArticleType", True),
+    )
+
+
 class HTML:
-    """Article HTML utility class."""
+    """Article HTML utility class.
 
-    def __init__(self, htmlpath, rootpath):
+    The article is parsed once. The body is kept as a BeautifulSoup tree
+    which is shared by scrubbing, image collection and link rewriting, and
+    is only serialized back to a string when the body is needed (e.g. to
+    build the Salesforce payload).
+    """
+
+    def __init__(self, htmlpath, rootpath, parser=None, fs=local_fs):
         """Parse article fields from HTML."""
-        with open(htmlpath, "r") as f:
+        with fs.open(htmlpath, "r") as f:
             html = f.read()
-        soup = BeautifulSoup(html, 'html.parser')
+        self.parser = parser or settings.HTML_PARSER
+        soup = BeautifulSoup(html, self.parser)
 
         self.htmlpath = htmlpath
         self.rootpath = rootpath
+        self.size = len(html)
 
-        # meta (Python attrname, HTML Name, Optional or not)
-        for attr, tag_name, optional in (
-            ('url_name', 'UrlName', False),
-            ('summary', 'description', True),
-            ('is_visible_in_csp', 'is-visible-in-csp', False),
-            ('is_visible_in_pkb', 'is-visible-in-pkb', False),
-            ('is_visible_in_prm', 'is-visible-in-prm', False),
-            ('author', settings.ARTICLE_AUTHOR, False),
-            ('docset_id', 'ProductMapUUID', True),  # Should be required but will break a lot of tests,
-            ('Topics__c', "HubTopics", True),
-            ('Article_Type__c', "ArticleType", True),
-        ):
+        for attr, tag_name, optional in article_meta_fields():
             tag = soup.find('meta', attrs={'name': tag_name})
             if optional and (not tag or not tag['content']):
                 setattr(self, attr, None)
@@ -75,10 +94,48 @@ class HTML:
             raise HtmlError('Body tag <div class={} ...> not found'.format(
                 settings.ARTICLE_BODY_CLASS,
             ))
-        self.body = body_tag.renderContents().decode('utf-8')
+        self._body_tag = body_tag
+        self._body = None
+        self._content_hash = None
+
+    def __getstate__(self):
+        # pickle the serialized body rather than the tree; the tree is
+        # parsed again only when it is needed
+        state = self.__dict__.copy()
+        state['_body'] = self.body
+        state['_body_tag'] = None
+        return state
+
+    def drop_tree(self):
+        """Keep only the serialized body.
+
+        The body tag holds on to the whole parsed document, many times the
+        size of the source HTML. The tree is parsed again if it is needed.
+        """
+        self._body = self.body
+        self._body_tag = None
+
+    def _tree(self):
+        """Article body as a BeautifulSoup tree."""
+        if self._body_tag is None:
+            self._body_tag = parse_fragment(self._body, self.parser)
+        return self._body_tag
+
+    @property
+    def body(self):
+        """Article body as a string, serialized on demand from the tree."""
+        if self._body is None:
+            self._body = self._body_tag.decode_contents()
+        return self._body
+
+    @body.setter
+    def body(self, html):
+        self._body_tag = None
+        self._body = html
+        self._content_hash = None
 
     def create_article_data(self):
-        return {
+        data = {
             'UrlName': self.url_name,
             'Title': self.title,
             'Summary': self.summary,
@@ -91,17 +148,58 @@ class HTML:
             settings.SALESFORCE_ARTICLE_AUTHOR_FIELD: self.author,
             settings.SALESFORCE_ARTICLE_AUTHOR_OVERRIDE_FIELD: self.author_override,
         }
+        if settings.SALESFORCE_ARTICLE_HASH_FIELD:
+            data[settings.SALESFORCE_ARTICLE_HASH_FIELD] = self.content_hash()
+        return data
+
+    def content_hash(self):
+        """SHA-256 of the article fields and body as they will be published.
+
+        Links to draft images are normalized to their public location, so a
+        draft and its published version have the same hash. The hash is kept
+        until the body changes.
+        """
+        if self._content_hash is not None:
+            return self._content_hash
+        self._content_hash = _hash_content({
+            'UrlName': self.url_name,
+            'Title': self.title,
+            'Summary': self.summary,
+            'IsVisibleInCsp': self.is_visible_in_csp,
+            'IsVisibleInPkb': self.is_visible_in_pkb,
+            'IsVisibleInPrm': self.is_visible_in_prm,
+            'Article_Type__c': self.Article_Type__c,
+            'Topics__c': self.Topics__c,
+            'author': self.author,
+            'author_override': self.author_override,
+            'body': self._production_body().strip(),
+        })
+        return self._content_hash
 
     def get_image_paths(self):
         """Get paths to linked images."""
         image_paths = set([])
-        soup = BeautifulSoup(self.body, 'html.parser')
-        for img in soup('img'):
+        for img in self._tree()('img'):
             image_paths.add(img['src'])
         return image_paths
 
     def same_as_record(self, record, logger):
-        """Compare this object with an article from a Salesforce query."""
+        """Compare this object with an article from a Salesforce query.
+
+        If SALESFORCE_ARTICLE_HASH_FIELD is set, only the content hashes are
+        compared and the record does not need to include the article body.
+        Records without a stored hash are treated as changed.
+        """
+        if settings.SALESFORCE_ARTICLE_HASH_FIELD:
+            stored_hash = record.get(settings.SALESFORCE_ARTICLE_HASH_FIELD)
+            if not stored_hash:
+                logger.info("Article has no content hash: %s", self.url_name)
+                return False
+            if stored_hash != self.content_hash():
+                logger.info("Article updated: %s", self.url_name)
+                return False
+            return True
+
         def compare(item1, item2, name):
             if not item1 and not item2:
                 return True
@@ -151,7 +249,7 @@ class HTML:
             "summary"
         )
         compare(
-            self.update_links_production(self.body).strip(),
+            self._production_body().strip(),
             record[settings.SALESFORCE_ARTICLE_BODY_FIELD].strip(),
             "body"
         )
@@ -161,48 +259,38 @@ class HTML:
 
     def scrub(self):
         """Scrub article body using whitelists for tags/attributes and links."""
-        problems = []
-
-        def scrub_tree(tree):
-            for child in tree.children:
-                if hasattr(child, 'contents'):
-                    if child.name not in settings.WHITELIST_HTML:
-                        problems.append('Tag "{}" not in whitelist'.format(child.name))
-                    else:
-                        for attr in child.attrs:
-                            if attr not in settings.WHITELIST_HTML[child.name]:
-                                problems.append('Tag "{}" attribute "{}" not in whitelist'.format(child.name, attr))
-                            if attr in ('href', 'src'):
-                                if not is_url_whitelisted(child[attr]):
-                                    problems.append('URL {} not whitelisted'.format(child[attr]))
-                        scrub_tree(child)
-        soup = BeautifulSoup(self.body, 'html.parser')
-        scrub_tree(soup)
-        return problems
+        return get_scrubber().scrub(self._tree())
 
-    def update_links_draft(self, docset_id, base_url=""):
-        """Update links to draft location."""
-        soup = BeautifulSoup(self.body, 'html.parser')
+    def update_links_draft(self, docset_id, base_url="", image_urls=None):
+        """Update links to draft location.
 
+        image_urls maps bundle-relative image paths to their draft URLs (see
+        utils.draft_image_urls). Without it, every image is checked on disk.
+        """
+        htmldir = os.path.dirname(self.htmlpath)
         article_link_count = 1
 
-        for a in soup('a'):
-            if 'href' in a.attrs:
-                o = urlparse(a['href'])
-                if o.scheme or not o.path or not is_html(o.path):
-                    continue
-                base_url_prefix = ''
-                if article_link_count > settings.SALESFORCE_ARTICLE_LINK_LIMIT:
-                    base_url_prefix = base_url
-                a['href'] = self.update_href(o, base_url_prefix)
-                article_link_count += 1
-        for img in soup('img'):
-            htmldir = os.path.dirname(self.htmlpath)
-            abspath_for_img = os.path.abspath(os.path.join(htmldir, img["src"]))
-            assert os.path.exists(abspath_for_img), abspath_for_img
+        def rewrite_href(href):
+            nonlocal article_link_count
+            o = urlparse(href)
+            if o.scheme or not o.path or not is_html(o.path):
+                return href
+            base_url_prefix = ''
+            if article_link_count > settings.SALESFORCE_ARTICLE_LINK_LIMIT:
+                base_url_prefix = base_url
+            article_link_count += 1
+            return self.update_href(o, base_url_prefix)
+
+        def rewrite_src(src):
+            abspath_for_img = os.path.abspath(os.path.join(htmldir, src))
             relname = utils.bundle_relative_path(self.rootpath, abspath_for_img)
-            img["src"] = Image.get_url(docset_id, relname, draft=True)
-        self.body = str(soup)
+            if image_urls is None:
+                assert os.path.exists(abspath_for_img), abspath_for_img
+                return Image.get_url(docset_id, relname, draft=True)
+            assert relname in image_urls, abspath_for_img
+            return image_urls[relname]
+
+        self.body = LinkRewriter(rewrite_href, rewrite_src).rewrite(self.body)
 
     def update_href(self, parsed_url, base_url):
         basename = os.path.basename(parsed_url.path)
@@ -217,20 +305,391 @@ class HTML:
 
         return new_href
 
+    def _production_body(self):
+        """The body as it will look once published."""
+        return self.update_links_production(self.body)
+
     @staticmethod
     def update_links_production(html):
         """Update links to production location."""
-        soup = BeautifulSoup(html, 'html.parser')
+        return LinkRewriter(rewrite_src=Image.draft_url_or_path_to_public).rewrite(html)
+
+
+def record_content_hash(record):
+    """HTML.content_hash of an article version from a Salesforce query.
+
+    The record must include its body, with links to the published images.
+    """
+    return _hash_content({
+        'UrlName': record.get('UrlName'),
+        'Title': record.get('Title'),
+        'Summary': record.get('Summary'),
+        'IsVisibleInCsp': record.get('IsVisibleInCsp'),
+        'IsVisibleInPkb': record.get('IsVisibleInPkb'),
+        'IsVisibleInPrm': record.get('IsVisibleInPrm'),
+        'Article_Type__c': record.get('Article_Type__c'),
+        'Topics__c': record.get('Topics__c'),
+        'author': record.get(settings.SALESFORCE_ARTICLE_AUTHOR_FIELD),
+        'author_override': record.get(settings.SALESFORCE_ARTICLE_AUTHOR_OVERRIDE_FIELD),
+        'body': (record.get(settings.SALESFORCE_ARTICLE_BODY_FIELD) or '').strip(),
+    })
+
+
+def _hash_content(content):
+    encoded = json.dumps(content, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class LinkRewriter(HTMLParser):
+    """Rewrite the href of <a> and the src of <img> tags in one pass.
+
+    The rewrite functions take an attribute value and return its new value.
+    The input is copied to the output unchanged, except for the tags whose
+    links actually changed, so nothing has to be parsed into a tree or
+    serialized again.
+    """
+
+    def __init__(self, rewrite_href=None, rewrite_src=None):
+        super().__init__()
+        self.rewriters = {}
+        if rewrite_href:
+            self.rewriters['a'] = ('href', rewrite_href)
+        if rewrite_src:
+            self.rewriters['img'] = ('src', rewrite_src)
+
+    def rewrite(self, html):
+        self.reset()
+        self.line_offsets = [0]
+        newline = html.find('\n')
+        while newline != -1:
+            self.line_offsets.append(newline + 1)
+            newline = html.find('\n', newline + 1)
+        self.replacements = []
+        self.feed(html)
+        self.close()
+        output = []
+        position = 0
+        for start, end, text in self.replacements:
+            output.append(html[position:start])
+            output.append(text)
+            position = end
+        output.append(html[position:])
+        return ''.join(output)
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in self.rewriters:
+            return
+        name, rewrite = self.rewriters[tag]
+        changed = False
+        new_attrs = []
+        for attr, value in attrs:
+            if attr == name and value is not None:
+                new_value = rewrite(value)
+                changed = changed or new_value != value
+                value = new_value
+            new_attrs.append((attr, value))
+        if changed:
+            raw = self.get_starttag_text()
+            line, column = self.getpos()
+            start = self.line_offsets[line - 1] + column
+            self.replacements.append(
+                (start, start + len(raw), self.format_starttag(tag, new_attrs, raw.endswith('/>')))
+            )
+
+    handle_startendtag = handle_starttag
+
+    @staticmethod
+    def format_starttag(tag, attrs, self_closing):
+        parts = [tag]
+        for attr, value in attrs:
+            if value is None:
+                parts.append(attr)
+            else:
+                value = value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+                parts.append('{}="{}"'.format(attr, value.replace('"', '&quot;')))
+        return '<{}{}>'.format(' '.join(parts), '/' if self_closing else '')
+
+
+class ArticleHeader:
+    """The <meta> tags and <title> of an article, read without parsing the body.
+
+    The file is streamed through an event-based parser which stops as soon
+    as the title and all the article meta tags have been seen, or at the
+    start of <body>. This is much cheaper than HTML for jobs that only need
+    the header, like naming a docset or looking for duplicate URL names.
+    """
+
+    chunk_size = 16 * 1024
+
+    def __init__(self, htmlpath, fs=local_fs):
+        self.htmlpath = htmlpath
+        self.meta = {}
+        self.title = None
+        wanted = {tag_name for attr, tag_name, optional in article_meta_fields()}
+        wanted.add(settings.ARTICLE_AUTHOR_OVERRIDE)
+        parser = _HeaderParser(self, wanted)
+        with fs.open(htmlpath, "r") as f:
+            try:
+                for chunk in iter(lambda: f.read(self.chunk_size), ''):
+                    parser.feed(chunk)
+                parser.close()
+            except _HeaderComplete:
+                pass
+
+    @property
+    def url_name(self):
+        return self.meta.get('UrlName')
+
+    def problems(self):
+        """Problems with the header that would make HTML() fail."""
+        problems = []
+        for attr, tag_name, optional in article_meta_fields():
+            if optional:
+                continue
+            if tag_name not in self.meta:
+                problems.append('Meta tag name={} not found in {}'.format(tag_name, self.htmlpath))
+            elif not self.meta[tag_name]:
+                problems.append('Meta tag name={} has no content in {}'.format(tag_name, self.htmlpath))
+        if self.title is None:
+            problems.append('Article title not found in {}'.format(self.htmlpath))
+        return problems
+
+
+class _HeaderComplete(Exception):
+    pass
+
+
+class _HeaderParser(HTMLParser):
+    """Feeds meta tags and the title into an ArticleHeader."""
+
+    def __init__(self, header, wanted):
+        super().__init__()
+        self.header = header
+        self.wanted = wanted
+        self.title = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'meta':
+            attrs = dict(attrs)
+            name = attrs.get('name')
+            # like BeautifulSoup.find, the first tag with a name wins
+            if name is not None and name not in self.header.meta:
+                self.header.meta[name] = attrs.get('content') or ''
+                self.check_complete()
+        elif tag == 'title' and self.header.title is None:
+            self.title = []
+        elif tag == 'body':
+            raise _HeaderComplete()
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+
+    def handle_data(self, data):
+        if self.title is not None:
+            self.title.append(data)
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self.title is not None:
+            self.header.title = ''.join(self.title)
+            self.title = None
+            self.check_complete()
+
+    def check_complete(self):
+        if self.header.title is not None and self.wanted.issubset(self.header.meta):
+            raise _HeaderComplete()
+
+
+def parse_fragment(html, parser=None):
+    """Parse a fragment of HTML, such as an article body.
+
+    Returns the tag whose contents are the fragment: lxml and html5lib wrap
+    fragments in <html><body>, html.parser does not.
+    """
+    parser = parser or settings.HTML_PARSER
+    soup = BeautifulSoup(html, parser)
+    if parser == 'html.parser' or soup.body is None:
+        return soup
+    return soup.body
+
+
+def compare_parsers(html_files, rootpath, parsers=('html.parser', 'lxml')):
+    """Parse articles with several parser backends and compare the results.
+
+    This is the conformance check to run before switching HTML_PARSER. It
+    returns a list of (html_file, field) for every article field whose
+    Salesforce payload differs between the backends, sorted by file. An
+    article that any backend cannot parse is reported as (html_file,
+    'error'): nothing of it was compared.
+    """
+    differences = []
+    for html_file in sorted(html_files):
+        payloads = []
+        try:
+            for parser in parsers:
+                payloads.append(HTML(html_file, rootpath, parser).create_article_data())
+        except HtmlError:
+            differences.append((html_file, 'error'))
+            continue
+        fields = sorted(set().union(*payloads))
+        for field in fields:
+            if len(set(repr(payload.get(field)) for payload in payloads)) > 1:
+                differences.append((html_file, field))
+    return differences
+
+
+class Scrubber:
+    """Check HTML trees against a tag/attribute whitelist and the link allowlist.
+
+    The whitelist is compiled into frozensets once. Problems are collapsed,
+    so that a tag which breaks the rules many times is reported once with a
+    count, and scrubbing stops after problem_limit distinct problems.
+    """
+
+    def __init__(self, whitelist, problem_limit):
+        self.whitelist = whitelist
+        self.tags = frozenset(whitelist)
+        self.attrs = {tag: frozenset(attrs) for tag, attrs in whitelist.items()}
+        self.problem_limit = problem_limit
+
+    def scrub(self, tree):
+        """Return the problems found in the children of tree."""
+        problems = {}
+        # Tags which are not whitelisted are reported but not descended into.
+        stack = list(reversed(tree.contents))
+        while stack:
+            node = stack.pop()
+            if not isinstance(node, Tag):
+                continue
+            found = []
+            if node.name not in self.tags:
+                found.append('Tag "{}" not in whitelist'.format(node.name))
+            else:
+                allowed = self.attrs[node.name]
+                for attr, value in node.attrs.items():
+                    if attr not in allowed:
+                        found.append('Tag "{}" attribute "{}" not in whitelist'.format(node.name, attr))
+                    if attr in ('href', 'src') and not is_url_whitelisted(value):
+                        found.append('URL {} not whitelisted'.format(value))
+                stack.extend(reversed(node.contents))
+            for problem in found:
+                if problem in problems:
+                    problems[problem] += 1
+                elif len(problems) < self.problem_limit:
+                    problems[problem] = 1
+                else:
+                    return self._report(problems) + [
+                        'Too many problems, stopped scrubbing after {}'.format(self.problem_limit)
+                    ]
+        return self._report(problems)
+
+    @staticmethod
+    def _report(problems):
+        return [
+            problem if count == 1 else '{} ({} times)'.format(problem, count)
+            for problem, count in problems.items()
+        ]
+
+
+_scrubber = None
+
+
+def get_scrubber():
+    """The Scrubber for the current whitelist settings."""
+    global _scrubber
+    if (
+        _scrubber is None
+        or _scrubber.whitelist is not settings.WHITELIST_HTML
+        or _scrubber.problem_limit != settings.SCRUB_PROBLEM_LIMIT
+    ):
+        _scrubber = Scrubber(settings.WHITELIST_HTML, settings.SCRUB_PROBLEM_LIMIT)
+    return _scrubber
+
+
+class ArticleStore:
+    """Parsed articles of one bundle, keyed by HTML path.
+
+    Articles are kept in memory, as serialized bodies without their parsed
+    trees, until the size of their source HTML reaches
+    settings.ARTICLE_STORE_MEMORY_BUDGET bytes. Articles added after that are
+    pickled to a temporary spill directory and loaded again on request.
+    Articles that were never added are parsed from the bundle in fs.
+    """
+
+    def __init__(self, rootpath, memory_budget=None, fs=local_fs):
+        self.rootpath = rootpath
+        self.fs = fs
+        if memory_budget is None:
+            memory_budget = settings.ARTICLE_STORE_MEMORY_BUDGET
+        self.memory_budget = memory_budget
+        self.memory_used = 0
+        self._articles = {}
+        self._spilled = {}
+        self._spill_dir = None
+        # spill files are never reused, see add
+        self._spill_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __contains__(self, htmlpath):
+        return htmlpath in self._articles or htmlpath in self._spilled
+
+    def __len__(self):
+        return len(self._articles) + len(self._spilled)
+
+    def add(self, html):
+        """Keep a parsed article, spilling it to disk if over budget."""
+        self.discard(html.htmlpath)
+        if self.memory_used + html.size <= self.memory_budget:
+            html.drop_tree()
+            self._articles[html.htmlpath] = html
+            self.memory_used += html.size
+            return
+        if self._spill_dir is None:
+            self._spill_dir = TemporaryDirectory(prefix="sfdoc_articles_")
+        self._spill_count += 1
+        filename = os.path.join(self._spill_dir.name, f"{self._spill_count}.pickle")
+        with open(filename, "wb") as f:
+            pickle.dump(html, f, pickle.HIGHEST_PROTOCOL)
+        self._spilled[html.htmlpath] = filename
+
+    def get(self, htmlpath):
+        """Get a parsed article, parsing it again if it was not kept."""
+        if htmlpath in self._articles:
+            return self._articles[htmlpath]
+        if htmlpath in self._spilled:
+            with open(self._spilled[htmlpath], "rb") as f:
+                return pickle.load(f)
+        return HTML(htmlpath, self.rootpath, fs=self.fs)
+
+    def pop(self, htmlpath):
+        """Get a parsed article and release the memory or disk it used."""
+        html = self.get(htmlpath)
+        self.discard(htmlpath)
+        return html
+
+    def discard(self, htmlpath):
+        if htmlpath in self._articles:
+            self.memory_used -= self._articles.pop(htmlpath).size
+        elif htmlpath in self._spilled:
+            os.remove(self._spilled.pop(htmlpath))
 
-        for img in soup('img'):
-            img["src"] = Image.draft_url_or_path_to_public(img["src"])
-        return str(soup)
+    def close(self):
+        self._articles = {}
+        self._spilled = {}
+        self.memory_used = 0
+        if self._spill_dir is not None:
+            self._spill_dir.cleanup()
+            self._spill_dir = None
 
 
-def collect_html_paths(path, logger):
+def collect_html_paths(path, logger, fs=local_fs):
     """Collect the HTML files referenced by the top-level HTMLs in a directory"""
     html_files = set()
-    for dirpath, dirnames, filenames in os.walk(path):
+    for dirpath, dirnames, filenames in fs.walk(path):
         for filename in filenames:
             filename_full = os.path.join(dirpath, filename)
             if is_html(filename):
@@ -0,0 +1,141 @@
+"""Check an easyDITA bundle the way process_bundle would, without Salesforce or S3.
+
+    python manage.py validate_bundle bundle.zip
+    python manage.py validate_bundle <easyDITA output UUID> --docset <resource id>
+
+Prints a JSON report and exits with an error if the bundle has problems
+that would make process_bundle fail, including images that are linked
+but missing. Images that are present but unreferenced are reported
+without failing.
+"""
+import json
+import logging
+import os
+from tempfile import TemporaryDirectory
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from sfdoc.publish import easydita
+from sfdoc.publish.bundlefs import DirectoryFS
+from sfdoc.publish.bundlefs import ZipFS
+from sfdoc.publish.html import ArticleHeader
+from sfdoc.publish.manifest import BundleManifest
+from sfdoc.publish.models import Bundle
+from sfdoc.publish.tasks import BUNDLE_IGNORE_PATTERNS
+from sfdoc.publish.tasks import _find_duplicate_urls
+from sfdoc.publish.tasks import _scrub_and_analyze_html
+from sfdoc.publish.tasks import _scrub_html_files
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument("bundle", help="bundle zip, unpacked bundle directory or easyDITA output UUID")
+        parser.add_argument("--docset", help="easyDITA resource ID (default: ProductMapUUID of the index file)")
+        parser.add_argument(
+            "--workers", type=int, default=os.cpu_count() or 1, help="processes scrubbing the articles"
+        )
+
+    def handle(self, *args, **options):
+        with TemporaryDirectory(prefix="validate_bundle_") as tempdir:
+            with self.open_bundle(options["bundle"], tempdir) as fs:
+                report = validate(fs, options["docset"], options["workers"])
+        report = {"bundle": options["bundle"], **report}
+        self.stdout.write(json.dumps(report, indent=2))
+        if not report["valid"]:
+            raise CommandError(f"{report['problem_count']} problems found in {options['bundle']}")
+
+    def open_bundle(self, name, tempdir):
+        if os.path.isdir(name):
+            return DirectoryFS(os.path.abspath(name))
+        if os.path.isfile(name):
+            return ZipFS(name, ignore_patterns=BUNDLE_IGNORE_PATTERNS)
+        # download it like process_bundle, without logging to the database
+        zip_path = os.path.join(tempdir, "bundle.zip")
+        with open(zip_path, "wb") as zip_file:
+            easydita.download_bundle(
+                Bundle(easydita_id=name).url,
+                zip_file,
+                logger,
+                auth=(settings.EASYDITA_USERNAME, settings.EASYDITA_PASSWORD),
+            )
+        return ZipFS(zip_path, ignore_patterns=BUNDLE_IGNORE_PATTERNS)
+
+
+def validate(fs, docset_id=None, workers=1):
+    """Report on the bundle in fs as a JSON-serializable dict."""
+    seconds = {}
+    start = time.monotonic()
+    manifest = BundleManifest.scan(fs)
+    seconds["manifest"] = time.monotonic() - start
+
+    def relpath(path):
+        return os.path.relpath(path, manifest.root)
+
+    index = {"files": [relpath(path) for path in manifest.index_files], "problems": []}
+    if len(manifest.index_files) == 1:
+        header = ArticleHeader(manifest.index_files[0], fs)
+        index.update(title=header.title, url_name=header.url_name, problems=header.problems())
+        docset_id = docset_id or header.meta.get("ProductMapUUID")
+    elif not manifest.index_files:
+        index["problems"].append("No index file found")
+    else:
+        index["problems"].append("Multiple index files found")
+
+    start = time.monotonic()
+    articles = {}
+    url_map = {}
+    referenced = set()
+    results = _scrub_html_files(
+        docset_id, manifest.html_files, manifest.root, fs, workers=workers, scrub=_scrub_or_report
+    )
+    for html_file, (html, problems, image_paths) in zip(manifest.html_files, results):
+        missing_images = sorted(relpath(path) for path in image_paths if not manifest.exists(path))
+        # process_bundle cannot link to them
+        problems.extend(f"Image {image} not found, linked from {relpath(html_file)}" for image in missing_images)
+        articles[relpath(html_file)] = {
+            "url_name": html.url_name if html else None,
+            "problems": problems,
+            "images": sorted(relpath(path) for path in image_paths),
+            "missing_images": missing_images,
+        }
+        if html:
+            url_map.setdefault(html.url_name.lower(), []).append(relpath(html_file))
+        referenced.update(image_paths)
+    seconds["scrub"] = time.monotonic() - start
+
+    duplicates = {url_name: sorted(paths) for url_name, paths in url_map.items() if len(paths) > 1}
+    # what process_bundle would reject
+    problems = (
+        index["problems"]
+        + [problem for article in articles.values() for problem in article["problems"]]
+        + _find_duplicate_urls(url_map)
+    )
+    return {
+        "docset_id": docset_id,
+        "root": os.path.relpath(manifest.root, fs.root),
+        "files": len(manifest.files),
+        "size": manifest.size,
+        "skipped_files": [relpath(path) for path in manifest.skipped_files],
+        "index": index,
+        "articles": articles,
+        "duplicate_url_names": duplicates,
+        "unused_images": sorted(relpath(path) for path in set(manifest.images) - referenced),
+        "problem_count": len(problems),
+        "valid": not problems,
+        "seconds": seconds,
+    }
+
+
+def _scrub_or_report(docset_id, html_file, path, fs):
+    try:
+        return _scrub_and_analyze_html(docset_id, html_file, path, fs)
+    except Exception as e:
+        # process_bundle would stop here, report it with the rest
+        return None, [f"{e} in {os.path.relpath(html_file, path)}"], set()
@@ -0,0 +1,154 @@
+from collections import namedtuple
+import hashlib
+import os
+
+from .bundlefs import local_fs
+from .utils import BUNDLE_ROOT_MARKER
+from .utils import find_bundle_root_above
+from .utils import is_html
+from .utils import skip_html_file
+
+IMAGE_EXTENSIONS = {".bmp", ".gif", ".jpeg", ".jpg", ".png", ".svg", ".webp"}
+
+
+# size and sha256 hex digest of one bundle file
+ManifestFile = namedtuple("ManifestFile", ["size", "sha256"])
+
+
+class BundleManifest:
+    """The files of a bundle, found in a single walk of its filesystem.
+
+    root is the bundle root directory (the one holding log.txt). Paths are
+    absolute, in the same form as the fs the bundle was scanned from:
+    index_files are the HTML files directly in root that name the docset,
+    html_files are the articles to publish and skipped_files the HTML files
+    left out by SKIP_HTML_FILES. files maps every file under root to its
+    ManifestFile, so later stages never have to stat or walk the bundle.
+    """
+
+    def __init__(self, root, files, html_files, skipped_files, index_files, images):
+        self.root = root
+        self.files = files
+        self.html_files = html_files
+        self.skipped_files = skipped_files
+        self.index_files = index_files
+        self.images = images
+
+    @classmethod
+    def scan(cls, fs=local_fs, top=None, logger=None):
+        """Walk fs from top (fs.root by default) and hash every file."""
+        top = top or fs.root
+        walked = list(fs.walk(top))
+        root = next(
+            (dirpath for dirpath, dirnames, filenames in walked if BUNDLE_ROOT_MARKER in filenames),
+            None,
+        )
+        if root is None:
+            # the bundle root is above top, walk it all
+            root = find_bundle_root_above(top, fs)
+            walked = list(fs.walk(root))
+
+        files = {}
+        html_files = []
+        skipped_files = []
+        index_files = []
+        images = []
+        for dirpath, dirnames, filenames in walked:
+            if dirpath != root and not dirpath.startswith(root + os.sep):
+                continue
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                files[path] = _hash_file(fs, path)
+                if dirpath == root and ".htm" in filename:
+                    index_files.append(path)
+                if is_html(filename):
+                    if skip_html_file(filename):
+                        if logger:
+                            logger.info("Skipping file: %s", path.replace(root + os.sep, ""))
+                        skipped_files.append(path)
+                    else:
+                        html_files.append(path)
+                elif os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                    images.append(path)
+        return cls(root, files, sorted(html_files), sorted(skipped_files), sorted(index_files), sorted(images))
+
+    def exists(self, path):
+        return os.path.normpath(path) in self.files
+
+    def hashes(self):
+        """Map root-relative paths of all files to their sha256."""
+        return {
+            os.path.relpath(path, self.root): entry.sha256
+            for path, entry in self.files.items()
+        }
+
+    @property
+    def size(self):
+        return sum(entry.size for entry in self.files.values())
+
+
+def _hash_file(fs, path):
+    sha256 = hashlib.sha256()
+    size = 0
+    with fs.open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+            size += len(chunk)
+    return ManifestFile(size, sha256.hexdigest())
+
+
+def manifest_record(manifest, articles, fingerprint):
+    """What a processed bundle leaves for delta detection of the next one.
+
+    articles maps root-relative HTML paths to (url_name, image paths);
+    fingerprint identifies the settings the articles were processed with.
+    """
+    return {
+        "fingerprint": fingerprint,
+        "files": manifest.hashes(),
+        "articles": {
+            os.path.relpath(html_file, manifest.root): {
+                "url_name": url_name,
+                "images": sorted(os.path.relpath(image, manifest.root) for image in images),
+            }
+            for html_file, (url_name, images) in articles.items()
+        },
+    }
+
+
+class BundleDelta:
+    """The files of a bundle compared with the last published bundle.
+
+    published is the manifest_record of the docset's last published
+    bundle. It is ignored when it was made with a different fingerprint,
+    and then every file counts as added. The sets hold root-relative paths.
+    """
+
+    def __init__(self, manifest, published, fingerprint):
+        if not published or published.get("fingerprint") != fingerprint:
+            published = {"files": {}, "articles": {}}
+        self.root = manifest.root
+        files = manifest.hashes()
+        old_files = published["files"]
+        self.unchanged = {name for name, sha256 in files.items() if old_files.get(name) == sha256}
+        self.changed = {name for name in files if name in old_files} - self.unchanged
+        self.added = set(files) - set(old_files)
+        self.removed = set(old_files) - set(files)
+        self._articles = published["articles"]
+
+    def unchanged_article(self, html_file):
+        """(url_name, image paths) of an unchanged article, or None.
+
+        An article whose images appeared or disappeared counts as changed,
+        because image links are only rewritten for images that exist.
+        """
+        name = os.path.relpath(html_file, self.root)
+        if name not in self.unchanged or name not in self._articles:
+            return None
+        article = self._articles[name]
+        if any(image in self.added or image in self.removed for image in article["images"]):
+            return None
+        return article["url_name"], {os.path.join(self.root, image) for image in article["images"]}
+
+    def is_unchanged(self, path):
+        return os.path.relpath(path, self.root) in self.unchanged
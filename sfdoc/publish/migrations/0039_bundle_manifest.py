@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('publish', '0038_article_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bundle',
+            name='manifest',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='docset',
+            name='published_manifest',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
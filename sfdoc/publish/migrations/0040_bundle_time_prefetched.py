@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('publish', '0039_bundle_manifest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bundle',
+            name='time_prefetched',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
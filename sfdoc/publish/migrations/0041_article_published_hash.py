@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('publish', '0040_bundle_time_prefetched'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='published_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -35,6 +35,10 @@ class Article(models.Model):
     kav_id = models.CharField(max_length=18)
     title = models.CharField(max_length=255, default='')
     url_name = models.CharField(max_length=255, default='')
+    content_hash = models.CharField(max_length=64, default='', blank=True)
+    # content hash of the version that was published, which differs from
+    # content_hash if the draft was edited in Salesforce
+    published_hash = models.CharField(max_length=64, default='', blank=True)
 
     def __str__(self):
         return '{} ({}) - {} : {}'.format(self.title, self.url_name, self.status, self.bundle)
@@ -87,7 +91,11 @@ class Bundle(models.Model):
     time_queued = models.DateTimeField(null=True, blank=True)
     time_processed = models.DateTimeField(null=True, blank=True)
     time_published = models.DateTimeField(null=True, blank=True)
+    # when prefetch_bundle was enqueued, it is only tried once
+    time_prefetched = models.DateTimeField(null=True, blank=True)
     time_last_modified = models.DateTimeField(auto_now=True)
+    # JSON manifest_record of the bundle's files, for delta detection
+    manifest = models.TextField(default='', blank=True)
 
     def __str__(self):
         return 'easyDITA bundle {} - {}'.format(self.pk, self.docset.display_name)
@@ -278,6 +286,8 @@ class Docset(models.Model):
         max_length=64,
         null=True,
     )
+    # manifest of the last published bundle
+    published_manifest = models.TextField(default='', blank=True)
 
     @classmethod
     def get_or_create_by_docset_id(cls, docset_id):
@@ -12,7 +12,9 @@ from simple_salesforce import exceptions as SimpleSalesforceExceptions, Salesfor
 
 from .exceptions import SalesforceError
 from .html import HTML
+from .html import record_content_hash
 from .models import Article
+from .shared_cache import get_shared_article_cache
 
 from .logger import get_logger
 from logging import getLogger
@@ -80,10 +82,93 @@ def get_community_base_url(api=None):
     )
 
 
+class ArticleRecords:
+    """Cached article versions of one publish status.
+
+    Records are kept by Id and indexed by KnowledgeArticleId and by
+    case-folded UrlName, so finding them takes the same time however many
+    articles a docset has. find() still compares all filters exactly.
+    """
+
+    def __init__(self, records=()):
+        self._by_id = {}
+        self._by_ka_id = {}
+        self._by_url_name = {}
+        for record in records:
+            self.add(record)
+
+    def __iter__(self):
+        return iter(list(self._by_id.values()))
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def get(self, kav_id):
+        return self._by_id.get(kav_id)
+
+    def add(self, record):
+        """Add record, replacing the record with the same Id."""
+        self.remove(record["Id"])
+        self._by_id[record["Id"]] = record
+        self._index(record)
+
+    def remove(self, kav_id):
+        record = self._by_id.pop(kav_id, None)
+        if record is not None:
+            self._unindex(record)
+
+    def update(self, kav_id, data):
+        """Set the fields in data that the record of kav_id has."""
+        record = self._by_id.get(kav_id)
+        if record is None:
+            return
+        self._unindex(record)
+        record.update((field, value) for field, value in data.items() if field in record)
+        self._index(record)
+
+    def find(self, **filters):
+        """The records whose fields equal all filters."""
+        if "Id" in filters:
+            record = self._by_id.get(filters["Id"])
+            candidates = [record] if record is not None else []
+        elif "KnowledgeArticleId" in filters:
+            candidates = self._by_ka_id.get(filters["KnowledgeArticleId"], {}).values()
+        elif "UrlName" in filters:
+            candidates = self._by_url_name.get(_fold(filters["UrlName"]), {}).values()
+        else:
+            candidates = self._by_id.values()
+        return [
+            record for record in candidates
+            if all(record[field] == value for field, value in filters.items())
+        ]
+
+    def _index(self, record):
+        if record.get("KnowledgeArticleId") is not None:
+            self._by_ka_id.setdefault(record["KnowledgeArticleId"], {})[record["Id"]] = record
+        if record.get("UrlName") is not None:
+            self._by_url_name.setdefault(_fold(record["UrlName"]), {})[record["Id"]] = record
+
+    def _unindex(self, record):
+        for index, value in (
+            (self._by_ka_id, record.get("KnowledgeArticleId")),
+            (self._by_url_name, _fold(record.get("UrlName"))),
+        ):
+            records = index.get(value)
+            if records is not None:
+                records.pop(record["Id"], None)
+                if not records:
+                    del index[value]
+
+
+def _fold(url_name):
+    return url_name.casefold() if url_name is not None else None
+
+
 class SalesforceArticles:
     """A docset-scoped or unscoped view of Salesforce Knowledge articles"""
 
     ALL_DOCSETS = ("#ALL",)  # token to represent a view that is not filtered by docset
+    FETCH_LIMIT = 200  # article versions queried by Id at once
     # class variables
     api = None
     _article_cache = {}
@@ -155,25 +240,32 @@ class SalesforceArticles:
         try:
             result = kav_api.create(data=data)
         except SimpleSalesforceExceptions.SalesforceMalformedRequest:
-            sf_api_logger.error(f"Error publishing {data['UrlName']}")
-            art = Article.objects.filter(url_name=data['UrlName']).last()
-            old, new = art.docset_id, self.sf_docset['Id']
-            if old!=new:
-                sf_api_logger.error(f"Perhaps the article moved between docsets?")
-                sf_api_logger.error(f"Old Docset: {old}")
-                sf_api_logger.error(f"New Docset: {new}")
+            self._log_create_error(data)
             raise
 
         kav_id = result['id']
         sf_api_logger.info("Creating article %s %s", kav_id, data)
-        self.invalidate_cache()     # I would prefer to update the cache but I
-        #                             would need to do a query to get the
-        #                             KnowledgeArticleId anyways. :(
+        # only the server knows the KnowledgeArticleId
+        self.fetch_cached([kav_id], 'draft')
         return kav_id
 
-    def create_draft(self, ka_id):
-        """Create a draft copy of a published article."""
-        self.invalidate_cache()
+    def _log_create_error(self, data):
+        sf_api_logger.error(f"Error publishing {data['UrlName']}")
+        art = Article.objects.filter(url_name=data['UrlName']).last()
+        if art is None:
+            return
+        old, new = art.docset_id, self.sf_docset['Id']
+        if old!=new:
+            sf_api_logger.error(f"Perhaps the article moved between docsets?")
+            sf_api_logger.error(f"Old Docset: {old}")
+            sf_api_logger.error(f"New Docset: {new}")
+
+    def create_draft(self, ka_id, fetch=True):
+        """Create a draft copy of a published article.
+
+        Without fetch, the new draft is not added to the article cache and
+        the caller has to fetch_cached() it.
+        """
         url = (
             self.api.base_url +
             'knowledgeManagement/articleVersions/masterVersions'
@@ -187,11 +279,12 @@ class SalesforceArticles:
             raise(e)
         kav_id = result.json()['id']
         sf_api_logger.info("Created draft %s for %s with %s", kav_id, ka_id, data)
+        if fetch:
+            self.fetch_cached([kav_id], 'draft')
         return kav_id
 
     def delete(self, kav_id):
         """Delete a KnowledgeArticleVersion."""
-        self.invalidate_cache()
         url = (
             self.api.base_url +
             'knowledgeManagement/articleVersions/masterVersions/{}'
@@ -202,6 +295,7 @@ class SalesforceArticles:
                 'Error deleting KnowledgeArticleVersion (ID={})'
             ).format(kav_id))
         sf_api_logger.info("Deleted draft %s : %s", kav_id, url)
+        self._cache_remove(kav_id, 'draft')
 
     def get_by_kav_id(self, kav_id, publish_status):
         try:
@@ -233,8 +327,11 @@ class SalesforceArticles:
         if filters:
             query_str += " WHERE "
 
-        query_str += ' AND '.join(f"{fieldname}='{value}'"
-                                  for fieldname, value in filters.items())
+        query_str += ' AND '.join(
+            f"{fieldname} IN ({','.join(repr(str(v)) for v in value)})" if isinstance(value, list)
+            else f"{fieldname}='{value}'"
+            for fieldname, value in filters.items()
+        )
 
         query_logger.info("QUERY: %s", query_str)
         result = self.api.query_all(query_str)
@@ -258,63 +355,135 @@ class SalesforceArticles:
         """ Return base URL e.g. https://powerofus.force.com """
         return get_community_base_url(self.api)
 
-    def process_draft(self, html, bundle):
+    def process_draft(self, html, bundle, image_urls=None):
         """Create a draft KnowledgeArticleVersion."""
-        logger = get_logger(bundle)
-
-        # update links to draft versions
-        html.update_links_draft(bundle.docset_id, self.get_base_url())
-
-        # query for existing article
-        result_draft = self.find_articles_by_name(html.url_name, 'draft')
-        result_online = self.find_articles_by_name(html.url_name, 'online')
-
-        if len(result_draft) == 1:
-            # draft exists, update fields
-            kav_id = result_draft[0]['Id']
-            self.update_draft(kav_id, html)
-            if len(result_online) == 1:
-                # published version exists
-                status = Article.STATUS_CHANGED
+        with self.draft_writer(bundle, image_urls) as drafts:
+            drafts.add(html)
+
+    def draft_writer(self, bundle, image_urls=None):
+        """A DraftWriter for the articles of bundle."""
+        return DraftWriter(self, bundle, image_urls)
+
+    def write_records(self, method, records):
+        """Create (POST) or update (PATCH) article versions in one request.
+
+        Uses sObject Collections where the API version has them, and the
+        Composite API before that. Returns one (id, errors) pair per record.
+        """
+        if float(settings.SALESFORCE_API_VERSION) >= 42.0:
+            result = self.api._call_salesforce(
+                method,
+                self.api.base_url + 'composite/sobjects',
+                json={'allOrNone': False, 'records': [
+                    {'attributes': {'type': settings.SALESFORCE_ARTICLE_TYPE}, **record}
+                    for record in records
+                ]},
+            )
+            return [
+                (item.get('id'), [f"{error['statusCode']}: {error['message']}" for error in item['errors']])
+                for item in result.json()
+            ]
+        sobjects_path = urlparse(self.api.base_url).path + 'sobjects/' + settings.SALESFORCE_ARTICLE_TYPE
+        subrequests = []
+        for n, record in enumerate(records):
+            record = dict(record)
+            url = sobjects_path
+            if method == 'PATCH':
+                url += '/' + record.pop('Id')
+            subrequests.append({'method': method, 'url': url, 'referenceId': f'record{n}', 'body': record})
+        result = self.api._call_salesforce(
+            'POST',
+            self.api.base_url + 'composite',
+            json={'allOrNone': False, 'compositeRequest': subrequests},
+        )
+        results = []
+        for record, item in zip(records, result.json()['compositeResponse']):
+            if item['httpStatusCode'] < 300:
+                results.append(((item['body'] or {}).get('id', record.get('Id')), []))
             else:
-                # not published
-                status = Article.STATUS_NEW
-            logger.info("Draft updated with DB status %s, %s", status, html.url_name)
-        elif len(result_online) == 0:
-            # new draft, new article
-            kav_id = self.create_article(html)
-            status = Article.STATUS_NEW
-            logger.info("Draft created with DB status %s, %s", status, html.url_name)
-        elif len(result_online) == 1:
-            # new draft of existing article
-            record = result_online[0]
-            # check for changes in article fields
-            if html.same_as_record(record, logger) and not settings.REPUBLISH_UNCHANGED_ARTICLES:
-                # no update
-                logger.info("Draft did not change: skipping: %s", html.url_name)
-                return
-            # create draft copy of published article
-            kav_id = self.create_draft(record['KnowledgeArticleId'])
-            self.update_draft(kav_id, html)
-            status = Article.STATUS_CHANGED
-            logger.info("New draft of published article, status %s, %s", status, html.url_name)
+                results.append((None, [f"{error['errorCode']}: {error['message']}" for error in item['body']]))
+        return results
 
-        self.save_article(kav_id, html, bundle, status)
-
-    def _cache_population_query(self, publish_status):
+    def _cache_fields(self, publish_status):
         fields = ["Id", "KnowledgeArticleId", "Title", "Summary", "IsVisibleInCsp",
                         "IsVisibleInPkb", "IsVisibleInPrm", "UrlName", "PublishStatus",
                         "Topics__c", "Article_Type__c",
-                        settings.SALESFORCE_ARTICLE_BODY_FIELD,
                         settings.SALESFORCE_ARTICLE_AUTHOR_FIELD,
                         settings.SALESFORCE_ARTICLE_AUTHOR_OVERRIDE_FIELD,
                         self.docset_uuid_join_field]
+        if settings.SALESFORCE_ARTICLE_HASH_FIELD:
+            fields.append(settings.SALESFORCE_ARTICLE_HASH_FIELD)
+        # bodies are left out, see fetch_bodies
+        if settings.SALESFORCE_SHARED_CACHE:
+            # to check shared records against the server
+            fields.append("SystemModstamp")
+        return fields
+
+    def _cache_population_query(self, publish_status, fields=None, **filters):
         where_clauses = {"language": "en_US",
-                         "PublishStatus": publish_status}
+                         "PublishStatus": publish_status,
+                         **filters}
         if self.docset_scoped:
             where_clauses[self.docset_uuid_join_field] = self.docset_uuid
 
-        return self.query_articles(fields, where_clauses)
+        return self.query_articles(fields or self._cache_fields(publish_status), where_clauses)
+
+    def fetch_bodies(self, records, publish_status):
+        """Query the body of the records that do not have it yet.
+
+        Cached records start without their bodies, which are by far their
+        largest field. They are queried FETCH_LIMIT records at a time by the
+        code that needs them: publishing a draft, and comparing an article
+        with its published version when there are no content hashes.
+        """
+        body_field = settings.SALESFORCE_ARTICLE_BODY_FIELD
+        missing = {}
+        for record in records:
+            if body_field not in record:
+                missing.setdefault(record["Id"], []).append(record)
+        kav_ids = list(missing)
+        for start in range(0, len(kav_ids), self.FETCH_LIMIT):
+            for row in self._cache_population_query(
+                publish_status, fields=["Id", body_field], Id=kav_ids[start:start + self.FETCH_LIMIT]
+            ):
+                for record in missing[row["Id"]]:
+                    record[body_field] = row[body_field]
+
+    def _load_records(self, publish_status):
+        """All records of publish_status, through the shared cache if enabled."""
+        shared = get_shared_article_cache()
+        if shared is None or not self.docset_scoped:
+            return self._cache_population_query(publish_status)
+        fields = self._cache_fields(publish_status)
+        # read before querying, so writes made meanwhile make the entry stale
+        version = shared.version(self.docset_uuid)
+        entry = shared.load(self.docset_uuid, publish_status, fields)
+        if entry is None:
+            records = self._cache_population_query(publish_status)
+        elif shared.is_current(entry, version):
+            return entry["records"]
+        else:
+            records = self._refresh_records(publish_status, entry["records"])
+        shared.store(self.docset_uuid, publish_status, fields, records, version)
+        return records
+
+    def _refresh_records(self, publish_status, records):
+        """Bring records up to date, querying only the article versions
+        that were added or changed on the server since."""
+        modstamps = {
+            record["Id"]: record["SystemModstamp"]
+            for record in self._cache_population_query(publish_status, fields=["Id", "SystemModstamp"])
+        }
+        current = {
+            record["Id"]: record for record in records
+            if record["Id"] in modstamps and record.get("SystemModstamp") == modstamps[record["Id"]]
+        }
+        changed = [kav_id for kav_id in modstamps if kav_id not in current]
+        query_logger.info("%d of %d shared %s records changed", len(changed), len(modstamps), publish_status)
+        for start in range(0, len(changed), self.FETCH_LIMIT):
+            for record in self._cache_population_query(publish_status, Id=changed[start:start + self.FETCH_LIMIT]):
+                current[record["Id"]] = record
+        return list(current.values())
 
     #  As with all caches, be careful with this one.
     #  Several things have bitten me with it already.
@@ -324,38 +493,108 @@ class SalesforceArticles:
     def query_articles_cached(self, publish_status, **filters):
         publish_status = publish_status.lower()
         key = (self.docset_uuid, publish_status)
-        if not self._article_cache.get(key):
-            self._article_cache[key] = self._cache_population_query(publish_status)
+        if key not in self._article_cache:
+            self._article_cache[key] = ArticleRecords(self._load_records(publish_status))
         elif settings.CACHE_VALIDATION_MODE:
-            assert self._article_cache[key] == self._cache_population_query(publish_status)
+            def by_id(records):
+                # bodies are compared by the code that fetched them
+                records = [
+                    {field: value for field, value in record.items() if field != settings.SALESFORCE_ARTICLE_BODY_FIELD}
+                    for record in records
+                ]
+                return sorted(records, key=lambda record: record["Id"])
+            assert by_id(self._article_cache[key]) == by_id(self._cache_population_query(publish_status))
 
-        def match(item):
-            return all(item[fieldname] == value for fieldname, value in filters.items())
-
-        return [a for a in self._article_cache[key] if match(a)]
+        return self._article_cache[key].find(**filters)
 
     @classmethod
     def invalidate_cache(cls):
         cls._article_cache = {}
 
+    # Writes go through to the cache: each change is applied to the cached
+    # records, and only records with fields that the server fills in, like
+    # the KnowledgeArticleId of a new article, are queried again.
+
+    def _cached_records(self, publish_status, docset_uuid=None):
+        """The cached ArticleRecords that a record of docset_uuid belongs in."""
+        docset_uuids = {self.ALL_DOCSETS, self.docset_uuid, docset_uuid}
+        return [
+            records for (uuid, status), records in self._article_cache.items()
+            if status == publish_status and uuid in docset_uuids
+        ]
+
+    def _find_cached(self, kav_id, publish_status):
+        for (uuid, status), records in self._article_cache.items():
+            if status == publish_status and records.get(kav_id) is not None:
+                return records.get(kav_id)
+        return None
+
+    def _cache_written(self):
+        # other workers must not use their shared records unchecked
+        shared = get_shared_article_cache()
+        if shared is not None and self.docset_scoped:
+            shared.bump(self.docset_uuid)
+
+    def _cache_add(self, record, publish_status):
+        self._cache_remove(record["Id"], publish_status)
+        relation = record.get(self.docset_relation) or {}
+        for records in self._cached_records(publish_status, relation.get(settings.SALESFORCE_DOCSET_ID_FIELD)):
+            records.add(dict(record))
+
+    def _cache_remove(self, kav_id, publish_status, **filters):
+        """Remove the record kav_id, or the records matching filters."""
+        self._cache_written()
+        if kav_id is not None:
+            filters["Id"] = kav_id
+        for (uuid, status), records in self._article_cache.items():
+            if status == publish_status:
+                for record in records.find(**filters):
+                    records.remove(record["Id"])
+
+    def _cache_update(self, kav_id, data):
+        """Apply the fields written to kav_id to its cached records."""
+        self._cache_written()
+        for records in self._article_cache.values():
+            records.update(kav_id, data)
+
+    def fetch_cached(self, kav_ids, publish_status):
+        """Query article versions and put them in the article cache.
+
+        Nothing is queried if no records of publish_status are cached: they
+        are all queried on the next lookup anyway.
+        """
+        if not self._cached_records(publish_status):
+            return
+        kav_ids = list(kav_ids)
+        for start in range(0, len(kav_ids), self.FETCH_LIMIT):
+            for record in self._cache_population_query(publish_status, Id=kav_ids[start:start + self.FETCH_LIMIT]):
+                self._cache_add(record, publish_status)
+
     def publish_draft(self, kav_id, logger = None):
         """Publish a draft KnowledgeArticleVersion."""
 
         logger = logger or sf_api_logger
         assert self.docset_scoped, "Need docset scoping to publish safely"
         kav = self.get_by_kav_id(kav_id, "draft")
+        self.fetch_bodies([kav], "draft")
         body = kav[settings.SALESFORCE_ARTICLE_BODY_FIELD]
         body = HTML.update_links_production(body)
         assert settings.AWS_S3_DRAFT_IMG_DIR not in body
+        # of the draft as it is in Salesforce, maybe edited since we wrote it
+        published_hash = record_content_hash({**kav, settings.SALESFORCE_ARTICLE_BODY_FIELD: body})
 
         data = {settings.SALESFORCE_ARTICLE_BODY_FIELD: body}
+        if settings.SALESFORCE_ARTICLE_HASH_FIELD:
+            data[settings.SALESFORCE_ARTICLE_HASH_FIELD] = published_hash
 
         if settings.SALESFORCE_ARTICLE_TEXT_INDEX_FIELD is not False:
             data[settings.SALESFORCE_ARTICLE_TEXT_INDEX_FIELD] = body
 
         kav_api = getattr(self.api, settings.SALESFORCE_ARTICLE_TYPE)
         kav_api.update(kav_id, data)
+        self._cache_update(kav_id, data)
         self.set_publish_status(kav_id, 'online')
+        Article.objects.filter(kav_id=kav_id).update(published_hash=published_hash)
 
     def find_articles_by_name(self, url_name, publish_status):
         """Query KnowledgeArticleVersion objects."""
@@ -374,6 +613,7 @@ class SalesforceArticles:
             status=status,
             title=html.title,
             url_name=html.url_name,
+            content_hash=html.content_hash(),
         )
 
     def set_publish_status(self, kav_id, status):
@@ -383,16 +623,25 @@ class SalesforceArticles:
             'knowledgeManagement/articleVersions/masterVersions/{}'
         ).format(kav_id)
         data = {'publishStatus': status}
-        self.invalidate_cache()
         result = self.api._call_salesforce('PATCH', url, json=data)
         if result.status_code != HTTPStatus.NO_CONTENT:
             raise SalesforceError((
                 'Error setting status={} for KnowledgeArticleVersion (ID={})'
             ).format(status, kav_id))
+        if status == 'online':
+            # the draft replaces the published version of its article
+            record = self._find_cached(kav_id, 'draft')
+            self._cache_remove(kav_id, 'draft')
+            if record is None:
+                self.fetch_cached([kav_id], 'online')
+                return
+            self._cache_remove(None, 'online', KnowledgeArticleId=record['KnowledgeArticleId'])
+            self._cache_add({**record, 'PublishStatus': 'Online'}, 'online')
+        else:
+            self._cache_remove(kav_id, 'online')
 
     def update_draft(self, kav_id, html):
         """Update the fields of an existing draft."""
-        self.invalidate_cache()
         assert self.docset_scoped, "Need docset scoping to write safely"
         kav_api = getattr(self.api, settings.SALESFORCE_ARTICLE_TYPE)
         data = html.create_article_data()
@@ -401,6 +650,7 @@ class SalesforceArticles:
             raise SalesforceError((
                 'Error updating draft KnowledgeArticleVersion (ID={})'
             ).format(kav_id))
+        self._cache_update(kav_id, data)
         return result
 
     @property
@@ -414,7 +664,7 @@ class SalesforceArticles:
         if not local_docset_obj.index_article_ka_id:
             url_name = local_docset_obj.index_article_url
             assert url_name
-            kav = [a for a in self.query_articles_cached("Online") if a["UrlName"] == url_name][0]
+            kav = self.query_articles_cached("Online", UrlName=url_name)[0]
             ka_id = kav["KnowledgeArticleId"]
             data = {settings.SALESFORCE_DOCSET_INDEX_REFERENCE_FIELD: ka_id}
             sf_docset_api.update(sf_docset_id, data)
@@ -422,6 +672,181 @@ class SalesforceArticles:
             local_docset_obj.save()
 
 
+def _published_hashes(kav_ids):
+    """Map the kav_ids of versions published by sfdoc to their content hashes.
+
+    The hash is taken from the draft when it is published. Published
+    versions cannot be edited, changing an article in Salesforce makes a
+    new version, so it is still the hash of the online version.
+    """
+    return dict(
+        Article.objects.filter(kav_id__in=kav_ids)
+        .exclude(published_hash='')
+        .values_list('kav_id', 'published_hash')
+    )
+
+
+class DraftWriter:
+    """Draft article versions of one bundle, written to Salesforce in batches.
+
+    add() works out from the article cache what an article needs: a new
+    article, a new draft of its published version, or an update of its
+    draft. Every SALESFORCE_DRAFT_BATCH_SIZE articles, and on close(), the
+    new articles are created and all drafts updated with as few requests
+    as the API allows. Failed records are collected with their HTML files
+    and raised together as a SalesforceError on close().
+    """
+
+    # records per request
+    COLLECTIONS_LIMIT = 200
+    COMPOSITE_LIMIT = 25
+
+    def __init__(self, salesforce_docset, bundle, image_urls=None):
+        self.sf = salesforce_docset
+        self.bundle = bundle
+        self.image_urls = image_urls
+        self.logger = get_logger(bundle)
+        self.base_url = salesforce_docset.get_base_url()
+        self.creates = []
+        self.published = []
+        self.new_drafts = []
+        self.updates = []
+        self.errors = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def __len__(self):
+        return len(self.creates) + len(self.published) + len(self.new_drafts) + len(self.updates)
+
+    def add(self, html):
+        """Plan the writes for one article."""
+        # update links to draft versions
+        html.update_links_draft(self.bundle.docset_id, self.base_url, self.image_urls)
+
+        # query for existing article
+        result_draft = self.sf.find_articles_by_name(html.url_name, 'draft')
+        result_online = self.sf.find_articles_by_name(html.url_name, 'online')
+
+        if len(result_draft) == 1:
+            # draft exists, update fields
+            if len(result_online) == 1:
+                # published version exists
+                status = Article.STATUS_CHANGED
+            else:
+                # not published
+                status = Article.STATUS_NEW
+            self.updates.append((result_draft[0]['Id'], html, status))
+        elif len(result_online) == 0:
+            # new draft, new article
+            self.creates.append(html)
+        elif len(result_online) == 1:
+            # new draft of existing article, if it changed; compared on
+            # flush, when the bodies are fetched for the whole batch
+            self.published.append((result_online[0], html))
+        else:
+            raise SalesforceError(
+                f'Found {len(result_draft)} drafts and {len(result_online)} published versions of {html.url_name}'
+            )
+        if len(self) >= settings.SALESFORCE_DRAFT_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Send the planned writes to Salesforce."""
+        if not len(self):
+            return
+        published_hashes = {}
+        if not settings.SALESFORCE_ARTICLE_HASH_FIELD:
+            # versions we published know their hash, the rest are compared
+            # with their bodies
+            published_hashes = _published_hashes([record['Id'] for record, html in self.published])
+            self.sf.fetch_bodies(
+                [record for record, html in self.published if record['Id'] not in published_hashes], 'online'
+            )
+        for record, html in self.published:
+            # check for changes in article fields
+            if record['Id'] in published_hashes:
+                same = published_hashes[record['Id']] == html.content_hash()
+                if not same:
+                    self.logger.info("Article updated: %s", html.url_name)
+            else:
+                same = html.same_as_record(record, self.logger)
+            if same and not settings.REPUBLISH_UNCHANGED_ARTICLES:
+                # no update
+                self.logger.info("Draft did not change: skipping: %s", html.url_name)
+                continue
+            self.new_drafts.append((record['KnowledgeArticleId'], html))
+        self.published = []
+        saved = []
+        # versions the server made, to be queried for the fields it filled in
+        new_kav_ids = []
+        # masterVersions is not an sObject, so drafts of published articles
+        # are still created one by one
+        for ka_id, html in self.new_drafts:
+            try:
+                kav_id = self.sf.create_draft(ka_id, fetch=False)
+            except SalesforceError as e:
+                self.errors.append(f'{html.htmlpath}: {e}')
+                continue
+            new_kav_ids.append(kav_id)
+            self.updates.append((kav_id, html, Article.STATUS_CHANGED))
+            self.logger.info("New draft of published article, %s", html.url_name)
+
+        records = []
+        for html in self.creates:
+            data = html.create_article_data()
+            data[settings.SALESFORCE_DOCSET_RELATION_FIELD] = self.sf.sf_docset['Id']
+            records.append(data)
+        for html, data, (kav_id, errors) in zip(self.creates, records, self._write('POST', records)):
+            if errors:
+                self.sf._log_create_error(data)
+                self.errors.extend(f'{html.htmlpath}: {error}' for error in errors)
+            else:
+                sf_api_logger.info("Creating article %s %s", kav_id, html.url_name)
+                self.logger.info("Draft created with DB status %s, %s", Article.STATUS_NEW, html.url_name)
+                new_kav_ids.append(kav_id)
+                saved.append((kav_id, html, Article.STATUS_NEW))
+
+        records = [{'Id': kav_id, **html.create_article_data()} for kav_id, html, status in self.updates]
+        for (kav_id, html, status), data, (result_id, errors) in zip(
+            self.updates, records, self._write('PATCH', records)
+        ):
+            if errors:
+                self.errors.extend(f'{html.htmlpath}: {error}' for error in errors)
+            else:
+                self.logger.info("Draft updated with DB status %s, %s", status, html.url_name)
+                self.sf._cache_update(kav_id, data)
+                saved.append((kav_id, html, status))
+
+        self.sf.fetch_cached(new_kav_ids, 'draft')
+        self.creates = []
+        self.new_drafts = []
+        self.updates = []
+        for kav_id, html, status in saved:
+            self.sf.save_article(kav_id, html, self.bundle, status)
+
+    def close(self):
+        self.flush()
+        if self.errors:
+            for error in self.errors:
+                self.logger.info("ERROR! %s", error)
+            raise SalesforceError('Error writing drafts:\n' + '\n'.join(self.errors))
+
+    def _write(self, method, records):
+        if float(settings.SALESFORCE_API_VERSION) >= 42.0:
+            limit = self.COLLECTIONS_LIMIT
+        else:
+            limit = self.COMPOSITE_LIMIT
+        results = []
+        for start in range(0, len(records), limit):
+            results.extend(self.sf.write_records(method, records[start:start + limit]))
+        return results
+
+
 if settings.CACHE_VALIDATION_MODE:
     print("!!! USING EXTREMELY SLOW CACHE VALIDATION MODE!            !!!")
     print("!!! This mode is slower than if there were no cache at all !!!")
@@ -0,0 +1,81 @@
+"""Salesforce article records shared by all workers through Redis.
+
+Each docset has a version stamp that is incremented whenever a worker
+writes to its articles, and one entry per publish status holding the
+records, the version they were read at and when they were last checked
+against Salesforce. An entry is only a starting point: before it is used,
+the Id and SystemModstamp of every article version are queried, and the
+records that changed on the server are queried again. Only an entry whose
+version is still current and which was checked less than
+SALESFORCE_SHARED_CACHE_CHECK_AFTER seconds ago is used as it is.
+
+The Docset admin action "Clear shared Salesforce article cache" drops the
+entries of a docset, for when they cannot be trusted, e.g. after changes
+in Salesforce that do not update SystemModstamp.
+"""
+import hashlib
+import json
+import time
+import zlib
+
+from django.conf import settings
+import django_rq
+
+
+class SharedArticleCache:
+    prefix = "sfdoc:articles"
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def version(self, docset_uuid):
+        return int(self.connection.get(self._version_key(docset_uuid)) or 0)
+
+    def bump(self, docset_uuid):
+        """Record that the articles of docset_uuid were written to."""
+        self.connection.incr(self._version_key(docset_uuid))
+
+    def load(self, docset_uuid, publish_status, fields):
+        """The entry for records with fields, or None."""
+        data = self.connection.get(self._key(docset_uuid, publish_status, fields))
+        if data is None:
+            return None
+        return json.loads(zlib.decompress(data))
+
+    def store(self, docset_uuid, publish_status, fields, records, version):
+        """Share records that were up to date at version."""
+        entry = {"version": version, "checked": time.time(), "records": records}
+        self.connection.set(
+            self._key(docset_uuid, publish_status, fields),
+            zlib.compress(json.dumps(entry).encode()),
+            ex=settings.SALESFORCE_SHARED_CACHE_TIMEOUT,
+        )
+
+    def is_current(self, entry, version):
+        """Whether entry can be used without checking it against Salesforce."""
+        return (
+            entry["version"] == version
+            and time.time() - entry["checked"] < settings.SALESFORCE_SHARED_CACHE_CHECK_AFTER
+        )
+
+    def invalidate(self, docset_uuid):
+        """Drop the entries of docset_uuid; they are queried again in full."""
+        self.bump(docset_uuid)
+        keys = list(self.connection.scan_iter(f"{self.prefix}:{docset_uuid}:records:*"))
+        if keys:
+            self.connection.delete(*keys)
+
+    def _version_key(self, docset_uuid):
+        return f"{self.prefix}:{docset_uuid}:version"
+
+    def _key(self, docset_uuid, publish_status, fields):
+        # entries of other field lists (other settings) are never mixed up
+        fields_hash = hashlib.sha256(",".join(fields).encode()).hexdigest()[:16]
+        return f"{self.prefix}:{docset_uuid}:records:{publish_status}:{fields_hash}"
+
+
+def get_shared_article_cache():
+    """The SharedArticleCache, or None if SALESFORCE_SHARED_CACHE is off."""
+    if not settings.SALESFORCE_SHARED_CACHE:
+        return None
+    return SharedArticleCache(django_rq.get_connection("default"))
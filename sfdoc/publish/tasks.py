@@ -1,40 +1,96 @@
-from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import hashlib
 import json
+from multiprocessing import get_context
 import os
 from tempfile import TemporaryDirectory
+from tempfile import TemporaryFile
 
+from django import db
 from django.conf import settings
+from django.db.models import F
 from django.utils.timezone import now
 from django_rq import job
-import requests
 
 from .amazon import S3
+from .bundlefs import local_fs
+from .exceptions import HtmlError
 from .exceptions import SfdocError
-from .html import HTML, collect_html_paths
+from .html import HTML, ArticleHeader, ArticleStore
 from .logger import get_logger
+from .manifest import BundleDelta
+from .manifest import BundleManifest
+from .manifest import manifest_record
+from .models import AllowedLinkset
 from .models import Article
 from .models import Bundle
 from .models import Image
 from .models import Webhook
 from .salesforce import SalesforceArticles
+from . import bundlefs
+from . import easydita
 from . import utils
 
+# bundle members that are never needed, left out when unpacking
+BUNDLE_IGNORE_PATTERNS = ["*/assets/*"]
 
-def _download_and_unpack_easydita_bundle(bundle, path):
+
+def _download_easydita_bundle(bundle, zip_file):
+    """Stream the bundle zip into zip_file and return its sha256 hex digest."""
     logger = get_logger(bundle)
 
     logger.info('Downloading easyDITA bundle from %s', bundle.url)
     assert bundle.url.startswith("https://")
     auth = (settings.EASYDITA_USERNAME, settings.EASYDITA_PASSWORD)
-    response = requests.get(bundle.url, auth=auth)
-    zip_file = BytesIO(response.content)
-    utils.unzip(zip_file, path, recursive=True, ignore_patterns=["*/assets/*"])
+    return easydita.download_bundle(bundle.url, zip_file, logger, auth=auth)
+
+
+def _open_easydita_bundle(bundle, spool_path=None):
+    """An open file of the bundle zip, from the bundle cache if possible.
+
+    Without a cache the zip is downloaded to spool_path, or to an anonymous
+    temporary file.
+    """
+    cache = easydita.get_bundle_cache()
+    if cache is None:
+        zip_file = open(spool_path, "w+b") if spool_path else TemporaryFile()
+        try:
+            _download_easydita_bundle(bundle, zip_file)
+        except BaseException:
+            zip_file.close()
+            raise
+        zip_file.seek(0)
+        return zip_file
+    zip_file = cache.open(bundle.easydita_id)
+    if zip_file is not None:
+        get_logger(bundle).info('Using cached easyDITA bundle %s', bundle.easydita_id)
+        return zip_file
+    return cache.add(bundle.easydita_id, partial(_download_easydita_bundle, bundle))
+
+
+def _download_and_unpack_easydita_bundle(bundle, path):
+    # spooled outside path so the zip does not end up in the unpacked bundle
+    with _open_easydita_bundle(bundle) as zip_file:
+        utils.unzip(zip_file, path, recursive=True, ignore_patterns=BUNDLE_IGNORE_PATTERNS)
+
+
+def _open_bundle_fs(bundle, path):
+    """The files of the bundle, unpacked into path or read from its zip."""
+    if settings.BUNDLE_FILESYSTEM == "zip":
+        with _open_easydita_bundle(bundle, os.path.join(path, "bundle.zip")) as zip_file:
+            return bundlefs.ZipFS(zip_file.name, ignore_patterns=BUNDLE_IGNORE_PATTERNS)
+    _download_and_unpack_easydita_bundle(bundle, path)
+    return bundlefs.DirectoryFS(path)
+
 
 def _process_bundle(bundle, path):
     logger = get_logger(bundle)
 
     # get APIs
     salesforce_docset = SalesforceArticles(bundle.docset_id)
+    # the article cache is kept up to date with our own writes only
+    salesforce_docset.invalidate_cache()
     s3 = S3(bundle)
 
     s3.delete_draft_images()
@@ -42,45 +98,44 @@ def _process_bundle(bundle, path):
     assert os.path.exists(path)
 
     # get new files from EasyDITA and put them on top
-    _download_and_unpack_easydita_bundle(bundle, path)
-
-    path = utils.find_bundle_root_directory(path)
-
-    # name docset for SFDoc UI and 
-    extract_docset_metadata_from_index_doc(bundle.docset, path)
+    with _open_bundle_fs(bundle, path) as fs:
+        # find root directory, index, HTML files and images in one walk
+        manifest = BundleManifest.scan(fs, logger=logger)
+        logger.info('Found %d HTML files and %d images, %d bytes in all',
+            len(manifest.html_files),
+            len(manifest.images),
+            manifest.size,
+        )
 
-    # collect paths to all HTML files
-    html_files = collect_html_paths(path, logger)
+        # name docset for SFDoc UI and 
+        extract_docset_metadata_from_index_doc(bundle.docset, manifest, fs)
 
-    create_drafts(bundle, html_files, path, salesforce_docset, s3)
+        create_drafts(bundle, manifest.html_files, manifest.root, salesforce_docset, s3, fs, manifest)
 
     bundle.status = bundle.STATUS_DRAFT
     bundle.save()
 
 
-def extract_docset_metadata_from_index_doc(docset, path):
+def extract_docset_metadata_from_index_doc(docset, manifest, fs=local_fs):
     """Try to name a docset from information in an index HTML"""
     logger = get_logger(docset)
     logger.info("Trying to name docset: %s", docset)
-    for dirpath, dirnames, filenames in os.walk(path):
-        html_files = [filename for filename in filenames if ".htm" in filename]
-        if html_files:
-            if len(html_files) > 1:
-                raise Exception(f"Multiple index files found in {path}")
-            index_file = os.path.join(dirpath, html_files[0])
-            html = HTML(index_file, path)
-            article_data = html.create_article_data()
-            docset.name = article_data['Title']  # for SFDoc UI
-            if docset.index_article_url != article_data['UrlName']:
-                docset.index_article_url = article_data['UrlName']  # To find the ka_id later 4 Hub_Product_Description
-                docset.index_article_ka_id = None          # Clear this to remember to update it later
-            docset.save()
-            assert docset.index_article_url, f"No UrlName found in {index_file}"
-            logger.info("Named: %s, %s", docset.name, docset.index_article_url)
-
-            return
-        else:
-            raise Exception("No index file found in " + path)
+    if not manifest.index_files:
+        raise Exception("No index file found in " + manifest.root)
+    if len(manifest.index_files) > 1:
+        raise Exception(f"Multiple index files found in {manifest.root}")
+    index_file = manifest.index_files[0]
+    header = ArticleHeader(index_file, fs)
+    problems = header.problems()
+    if problems:
+        raise HtmlError("\n".join(problems))
+    docset.name = header.title  # for SFDoc UI
+    if docset.index_article_url != header.url_name:
+        docset.index_article_url = header.url_name  # To find the ka_id later 4 Hub_Product_Description
+        docset.index_article_ka_id = None          # Clear this to remember to update it later
+    docset.save()
+    assert docset.index_article_url, f"No UrlName found in {index_file}"
+    logger.info("Named: %s, %s", docset.name, docset.index_article_url)
 
 
 def _find_duplicate_urls(url_map):
@@ -97,47 +152,155 @@ def _find_duplicate_urls(url_map):
     return problems
 
 
-def _scrub_and_analyze_html(
-    bundle, html_file, path, article_image_map, images, url_map, problems
-):
-    html = HTML(html_file, path)
-    if html.docset_id and html.docset_id != bundle.docset_id:
+def _scrub_and_analyze_html(docset_id, html_file, path, fs=local_fs):
+    """Scrub one HTML file.
+
+    Returns the parsed article, its problems and the absolute paths of the
+    images it references. This runs in scrub worker processes, so it must
+    not touch the database models or any shared state.
+    """
+    html = HTML(html_file, path, fs=fs)
+    problems = []
+    # docset_id is None when validating a bundle of unknown docset
+    if docset_id and html.docset_id and html.docset_id != docset_id:
         problems.append(
-            f"HTML ProductMapUUID {html.docset_id} does not match bundle ID, {bundle.docset_id} in {html_file}")
+            f"HTML ProductMapUUID {html.docset_id} does not match bundle ID, {docset_id} in {html_file}")
 
-    scrub_problems = html.scrub()
-    if scrub_problems:
-        problems.extend(scrub_problems)
-    article_image_map[html.url_name] = set([])
+    problems.extend(html.scrub())
+    image_paths = set([])
     for image_path in html.get_image_paths():
-        image_path_full = os.path.abspath(
+        image_paths.add(os.path.abspath(
             os.path.join(os.path.dirname(html_file), image_path)
-        )
-        article_image_map[html.url_name].add(image_path_full)
-        images.add(image_path_full)
-    url_name = html.url_name.lower()
-    if url_name not in url_map:
-        url_map[url_name] = []
-    url_map[url_name].append(html_file)
+        ))
+    return html, problems, image_paths
+
+
+def _scrub_html_files(docset_id, html_files, path, fs=local_fs, workers=None, scrub=_scrub_and_analyze_html):
+    """Scrub HTML files, in a process pool if workers (default
+    SCRUB_WORKERS) > 1.
+
+    scrub is called like _scrub_and_analyze_html, whose results are yielded
+    in the order of html_files.
+    """
+    scrub = partial(scrub, docset_id, path=path, fs=fs)
+    if workers is None:
+        workers = settings.SCRUB_WORKERS
+    workers = min(workers, len(html_files))
+    if workers <= 1:
+        yield from map(scrub, html_files)
+        return
+    # build the link allowlist once here instead of once per worker
+    utils.get_url_matcher()
+    # forked workers must not share the parent's database connections
+    db.connections.close_all()
+    chunksize = max(1, len(html_files) // (workers * 4))
+    chunks = [html_files[i:i + chunksize] for i in range(0, len(html_files), chunksize)]
+    # scrub, and the fs it reads from, are inherited by the forked workers
+    # rather than pickled with every chunk
+    with ProcessPoolExecutor(
+        workers, mp_context=get_context("fork"), initializer=_init_scrub_worker, initargs=(scrub,)
+    ) as pool:
+        futures = [pool.submit(_scrub_chunk, chunk) for chunk in chunks]
+        try:
+            for future in futures:
+                yield from future.result()
+        finally:
+            # don't start on chunks nobody will look at
+            for future in futures:
+                future.cancel()
+
+
+_worker_scrub = None
+
+
+def _init_scrub_worker(scrub):
+    global _worker_scrub
+    _worker_scrub = scrub
+
+
+def _scrub_chunk(html_files):
+    return [_worker_scrub(html_file) for html_file in html_files]
+
 
+def create_drafts(bundle, html_files, path, salesforce_docset, s3, fs=local_fs, manifest=None):
+    with ArticleStore(path, fs=fs) as articles:
+        _create_drafts(bundle, html_files, path, salesforce_docset, s3, articles, fs, manifest)
 
-def create_drafts(bundle, html_files, path, salesforce_docset, s3):
+
+def _create_drafts(bundle, html_files, path, salesforce_docset, s3, articles, fs, manifest):
     # check all HTML files and create list of referenced image files
     logger = get_logger(bundle)
     url_map = {}
     images = set([])
     article_image_map = {}
-    logger.info('Scrubbing all HTML files in %s', bundle)
     problems = []
-    for n, html_file in enumerate(html_files, start=1):
-        logger.info('Scrubbing HTML file %d of %d: %s',
+    # sorted, so that problems are always reported in the same order
+    html_files = sorted(html_files)
+
+    # articles unchanged since the last published bundle keep what we
+    # learned about them then, and are not scrubbed or uploaded again
+    fingerprint = _processing_fingerprint()
+    delta = _bundle_delta(bundle, manifest, fingerprint)
+    processed = {}
+    if delta is not None:
+        logger.info(
+            'Compared to the last published bundle: %d files unchanged, %d changed, %d added, %d removed',
+            len(delta.unchanged),
+            len(delta.changed),
+            len(delta.added),
+            len(delta.removed),
+        )
+        for html_file in html_files:
+            article = delta.unchanged_article(html_file)
+            if article is not None:
+                processed[html_file] = article
+        # unless they were changed in Salesforce in the meantime
+        published = _published_by_sfdoc(salesforce_docset, [url_name for url_name, images in processed.values()])
+        for html_file, (url_name, images) in list(processed.items()):
+            if url_name not in published:
+                logger.info('Processing unchanged %s again, it changed in Salesforce', url_name)
+                del processed[html_file]
+    # articles validated by prefetch_bundle are uploaded, but not scrubbed
+    validated = {}
+    prefetched = _prefetched_delta(bundle, manifest, fingerprint)
+    if prefetched is not None:
+        for html_file in html_files:
+            article = prefetched.unchanged_article(html_file)
+            if article is not None and html_file not in processed:
+                validated[html_file] = article
+        logger.info('Using the prefetched manifest for %d HTML files', len(validated))
+    for html_file, (url_name, image_paths) in list(processed.items()) + list(validated.items()):
+        images.update(image_paths)
+        url_map.setdefault(url_name.lower(), []).append(html_file)
+    processed.update(validated)
+    html_files = [html_file for html_file in html_files if html_file not in processed]
+
+    logger.info('Scrubbing all HTML files in %s', bundle)
+    results = _scrub_html_files(bundle.docset_id, html_files, path, fs)
+    for n, (html_file, (html, html_problems, image_paths)) in enumerate(
+        zip(html_files, results), start=1
+    ):
+        logger.info('Scrubbed HTML file %d of %d: %s',
             n,
             len(html_files),
             html_file.replace(path + os.sep, ''),
         )
-        _scrub_and_analyze_html(
-            bundle, html_file, path, article_image_map, images, url_map, problems
-        )
+        problems.extend(html_problems)
+        article_image_map[html.url_name] = image_paths
+        images.update(image_paths)
+        url_name = html.url_name.lower()
+        if url_name not in url_map:
+            url_map[url_name] = []
+        url_map[url_name].append(html_file)
+        articles.add(html)
+        processed[html_file] = (html.url_name, image_paths)
+        if len(problems) >= settings.SCRUB_PROBLEM_LIMIT:
+            problems.append(
+                f"Too many problems, stopped scrubbing after {n} of {len(html_files)} HTML files"
+            )
+            break
+    results.close()
+    html_files = sorted(html_files + list(validated))
 
 
     # check for duplicate URL names
@@ -159,31 +322,130 @@ def create_drafts(bundle, html_files, path, salesforce_docset, s3):
     logger.info('Uploading draft articles and images')
     # process HTML files
 
-    # NOTE: there is a major optimization opportunity here: we could collect
-    #       information about what to do on SF and then make a single batch
-    #       update call.
-    for n, html_file in enumerate(html_files, start=1):
-        logger.info('Processing HTML file %d of %d: %s',
-            n,
-            len(html_files),
-            html_file.replace(path + os.sep, ''),
-        )
-        html = HTML(html_file, path)
-        salesforce_docset.process_draft(html, bundle)
+    # drafts are written in batches, see DraftWriter
+    image_urls = utils.draft_image_urls(bundle.docset_id, path, images, manifest or fs)
+    with salesforce_docset.draft_writer(bundle, image_urls) as drafts:
+        for n, html_file in enumerate(html_files, start=1):
+            logger.info('Processing HTML file %d of %d: %s',
+                n,
+                len(html_files),
+                html_file.replace(path + os.sep, ''),
+            )
+            drafts.add(articles.pop(html_file))
     # process images
+    if delta is not None:
+        # drafts need the images they link to, the rest only if changed
+        images = {
+            image for html_file in html_files for image in processed[html_file][1]
+        } | {image for image in images if not delta.is_unchanged(image)}
     for n, image in enumerate(images, start=1):
         logger.info('Processing image file %d of %d: %s',
             n,
             len(images),
             image.replace(path + os.sep, ''),
         )
-        s3.process_image(image, path)
+        s3.process_image(image, path, fs)
+    if manifest is not None:
+        bundle.manifest = json.dumps(manifest_record(manifest, processed, fingerprint))
     # error if nothing changed
     if not bundle.articles.count() and not bundle.images.count():
         raise SfdocError('No articles or images changed')
     # finish
 
 
+def _processing_fingerprint():
+    """Hash of the settings, besides the bundle files, that decide how
+    articles are scrubbed and what is uploaded for them."""
+    return hashlib.sha256(json.dumps([
+        settings.WHITELIST_HTML,
+        sorted(AllowedLinkset.all_urls()),
+        settings.SKIP_HTML_FILES,
+        settings.HTML_PARSER,
+        settings.ARTICLE_AUTHOR,
+        settings.ARTICLE_AUTHOR_OVERRIDE,
+        settings.ARTICLE_BODY_CLASS,
+        settings.AWS_S3_BUCKET,
+        settings.AWS_S3_DRAFT_IMG_DIR,
+        settings.AWS_S3_PUBLIC_IMG_DIR,
+        settings.SALESFORCE_ARTICLE_BODY_FIELD,
+        settings.SALESFORCE_ARTICLE_AUTHOR_FIELD,
+        settings.SALESFORCE_ARTICLE_AUTHOR_OVERRIDE_FIELD,
+        settings.SALESFORCE_ARTICLE_HASH_FIELD,
+        settings.SALESFORCE_ARTICLE_LINK_LIMIT,
+        settings.SALESFORCE_ARTICLE_URL_PATH_PREFIX,
+        settings.SALESFORCE_COMMUNITY,
+        settings.SALESFORCE_SANDBOX,
+    ], sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _bundle_delta(bundle, manifest, fingerprint):
+    """Changes since the docset's last published bundle, or None to
+    process the whole bundle."""
+    if (
+        manifest is None
+        or not settings.BUNDLE_DELTA_DETECTION
+        or settings.REPUBLISH_UNCHANGED_ARTICLES
+    ):
+        return None
+    published = bundle.docset.published_manifest
+    return BundleDelta(manifest, json.loads(published) if published else None, fingerprint)
+
+
+def _published_by_sfdoc(salesforce_docset, url_names):
+    """The url_names whose online version sfdoc published as it wrote it,
+    and which have no draft.
+
+    Other articles were edited, archived or drafted in Salesforce, or their
+    draft was edited before it was published. They are processed to bring
+    them back in line with the bundle.
+    """
+    online = {}
+    for url_name in url_names:
+        if salesforce_docset.find_articles_by_name(url_name, 'draft'):
+            continue
+        records = salesforce_docset.find_articles_by_name(url_name, 'online')
+        if len(records) == 1:
+            online[records[0]['Id']] = url_name
+    kav_ids = (
+        Article.objects.filter(kav_id__in=list(online), published_hash=F('content_hash'))
+        .exclude(published_hash='')
+        .exclude(status=Article.STATUS_DELETED)
+        .values_list('kav_id', flat=True)
+    )
+    return {online[kav_id] for kav_id in kav_ids}
+
+
+def _prefetched_delta(bundle, manifest, fingerprint):
+    """The bundle's files compared with the manifest stored when it was
+    prefetched, or None if it was not prefetched."""
+    if manifest is None or not bundle.manifest:
+        return None
+    return BundleDelta(manifest, json.loads(bundle.manifest), fingerprint)
+
+
+def _validate_bundle(bundle, manifest, fs):
+    """Scrub all articles of the bundle and check their URL names.
+
+    Returns the manifest_record of the bundle, or raises SfdocError with
+    the problems found. Nothing here depends on Salesforce or S3.
+    """
+    articles = {}
+    url_map = {}
+    problems = []
+    results = _scrub_html_files(bundle.docset_id, manifest.html_files, manifest.root, fs)
+    for html_file, (html, html_problems, image_paths) in zip(manifest.html_files, results):
+        problems.extend(html_problems)
+        url_map.setdefault(html.url_name.lower(), []).append(html_file)
+        articles[html_file] = (html.url_name, image_paths)
+        if len(problems) >= settings.SCRUB_PROBLEM_LIMIT:
+            break
+    results.close()
+    problems.extend(_find_duplicate_urls(url_map))
+    if problems:
+        raise SfdocError(repr(problems))
+    return manifest_record(manifest, articles, _processing_fingerprint())
+
+
 def _record_archivable_articles(salesforce_docset, bundle, url_map):
     # build list of published articles to archive
     for article in salesforce_docset.get_articles("online"):
@@ -217,6 +479,8 @@ def _record_deletable_images(s3, root_path, images, bundle):
 def _publish_drafts(bundle):
     logger = get_logger(bundle)
     salesforce_docset = SalesforceArticles(bundle.docset_id)
+    # the article cache is kept up to date with our own writes only
+    salesforce_docset.invalidate_cache()
     s3 = S3(bundle)
     # publish articles
     articles = bundle.articles.filter(status__in=[
@@ -224,6 +488,11 @@ def _publish_drafts(bundle):
         Article.STATUS_CHANGED,
     ])
     N = articles.count()
+    # fetch the draft bodies in batches rather than one by one
+    salesforce_docset.fetch_bodies(
+        [salesforce_docset.get_by_kav_id(kav_id, "draft") for kav_id in articles.values_list("kav_id", flat=True)],
+        "draft",
+    )
     for n, article in enumerate(articles.all(), start=1):
         logger.info('Publishing article %d of %d: %s', n, N, article)
         salesforce_docset.publish_draft(article.kav_id, logger)
@@ -269,6 +538,9 @@ def process_bundle(bundle_pk):
     logger = get_logger(bundle)
     logger.info('Processing %s', bundle)
 
+    # pick up changes to the link allowlist made since the last job
+    utils.reset_url_matcher()
+
     with TemporaryDirectory(f"bundle_{bundle.pk}") as tempdir:
         try:
             _process_bundle(
@@ -283,6 +555,41 @@ def process_bundle(bundle_pk):
     logger.info('Processed %s', bundle)
 
 
+@job("default", timeout=600)
+def prefetch_bundle(bundle_pk):
+    """
+    Download and validate a queued bundle while its docset is busy.
+
+    None of this depends on Salesforce, so it can run while another bundle
+    of the docset waits for review. The downloaded zip stays in the bundle
+    cache, and the manifest of a bundle without problems is stored, so that
+    process_bundle does not scrub its articles again. Problems are only
+    logged: the bundle fails when it is processed. process_bundle_queues
+    enqueues this once per bundle, see Bundle.time_prefetched.
+    """
+    bundle = Bundle.objects.get(pk=bundle_pk)
+    if bundle.status != Bundle.STATUS_QUEUED or bundle.manifest:
+        return
+    logger = get_logger(bundle)
+    logger.info('Prefetching %s', bundle)
+    utils.reset_url_matcher()
+
+    with TemporaryDirectory(f"prefetch_{bundle.pk}") as tempdir:
+        try:
+            with _open_bundle_fs(bundle, tempdir) as fs:
+                manifest = BundleManifest.scan(fs)
+                record = _validate_bundle(bundle, manifest, fs)
+        except Exception as e:
+            logger.info('Prefetch found problems, leaving them to processing: %s', e)
+            return
+
+    # unless processing started in the meantime
+    Bundle.objects.filter(pk=bundle.pk, status=Bundle.STATUS_QUEUED, manifest='').update(
+        manifest=json.dumps(record),
+    )
+    logger.info('Prefetched %s', bundle)
+
+
 @job
 def process_bundle_queues():
     """Process the next easyDITA bundle in the queue."""
@@ -307,6 +614,14 @@ def process_bundle_queues():
                 bundle_to_process.status = Bundle.STATUS_PROCESSING
                 bundle_to_process.save()
                 process_bundle.delay(bundle_to_process.pk)
+            elif settings.BUNDLE_PREFETCH:
+                # get the next bundle ready while the docset is busy
+                bundle_to_prefetch = bundles_for_docset.earliest('time_queued')
+                # once: a bundle with problems never gets a manifest
+                if Bundle.objects.filter(
+                    pk=bundle_to_prefetch.pk, manifest='', time_prefetched=None,
+                ).update(time_prefetched=now()):
+                    prefetch_bundle.delay(bundle_to_prefetch.pk, job_id=f'prefetch_bundle_{bundle_to_prefetch.pk}')
 
 
 @job
@@ -363,5 +678,10 @@ def publish_drafts(bundle_pk):
     bundle.status = Bundle.STATUS_PUBLISHED
     bundle.time_published = now()
     bundle.save()
+    if bundle.manifest:
+        # the next bundle of the docset is compared to this one
+        docset = bundle.docset
+        docset.published_manifest = bundle.manifest
+        docset.save()
     logger.info('Published all drafts for %s', bundle)
     process_bundle_queues.delay()
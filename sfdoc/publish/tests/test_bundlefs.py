@@ -0,0 +1,94 @@
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import glob
+from multiprocessing import get_context
+import os
+import pickle
+from tempfile import TemporaryDirectory
+from zipfile import ZIP_DEFLATED, ZipFile
+
+from test_plus.test import TestCase
+
+from .. import bundlefs
+from .. import utils
+from .utils import rootdir
+
+IGNORE_PATTERNS = ["*/assets/*"]
+
+
+def read_text(fs, path):
+    with fs.open(path, "r") as f:
+        return f.read()
+
+
+_forked_fs = None
+
+
+def set_forked_fs(fs):
+    global _forked_fs
+    _forked_fs = fs
+
+
+def read_forked(path):
+    return read_text(_forked_fs, path)
+
+
+def walk_files(fs, top):
+    return sorted(
+        os.path.relpath(os.path.join(dirpath, filename), top)
+        for dirpath, dirnames, filenames in fs.walk(top)
+        for filename in filenames
+    )
+
+
+class TestZipFS(TestCase):
+    def test_same_as_unzip(self):
+        for zip_path in glob.glob(os.path.join(rootdir, "testdata/bundles/*.zip")):
+            with TemporaryDirectory() as path, \
+                    bundlefs.ZipFS(zip_path, ignore_patterns=IGNORE_PATTERNS) as fs:
+                utils.unzip(zip_path, path, recursive=True, ignore_patterns=IGNORE_PATTERNS)
+                filenames = walk_files(bundlefs.local_fs, path)
+                self.assertEqual(walk_files(fs, fs.root), filenames)
+                for filename in filenames:
+                    with open(os.path.join(path, filename), "rb") as f, \
+                            fs.open(os.path.join(fs.root, filename)) as member:
+                        self.assertEqual(member.read(), f.read(), filename)
+                self.assertEqual(
+                    os.path.relpath(utils.find_bundle_root_directory(fs.root, fs), fs.root),
+                    os.path.relpath(utils.find_bundle_root_directory(path), path),
+                )
+
+    def test_compressed_inner_zip(self):
+        inner = BytesIO()
+        with ZipFile(inner, "w", ZIP_DEFLATED) as f:
+            f.writestr("bundle/log.txt", "log")
+            f.writestr("bundle/topics/article.html", "<html></html>")
+        with TemporaryDirectory() as path:
+            zip_path = os.path.join(path, "bundle.zip")
+            with ZipFile(zip_path, "w", ZIP_DEFLATED) as f:
+                f.writestr("outer/inner.zip", inner.getvalue())
+            with bundlefs.ZipFS(zip_path, root="/zip") as fs:
+                self.assertTrue(fs.exists("/zip/outer/inner/bundle"))
+                self.assertFalse(fs.exists("/zip/outer/inner.zip"))
+                self.assertEqual(utils.find_bundle_root_directory("/zip", fs), "/zip/outer/inner/bundle")
+                with fs.open("/zip/outer/inner/bundle/topics/article.html", "r") as f:
+                    self.assertEqual(f.read(), "<html></html>")
+                with self.assertRaises(FileNotFoundError):
+                    fs.open("/zip/outer/inner/bundle/missing.html")
+
+    def test_forked_readers(self):
+        with TemporaryDirectory() as path:
+            zip_path = os.path.join(path, "bundle.zip")
+            with ZipFile(zip_path, "w", ZIP_DEFLATED) as f:
+                for n in range(20):
+                    f.writestr(f"{n}.txt", str(n) * 100000)
+            fs = bundlefs.ZipFS(zip_path)
+            # e.g. evicted from the bundle cache
+            os.remove(zip_path)
+        with fs, ProcessPoolExecutor(
+            4, mp_context=get_context("fork"), initializer=set_forked_fs, initargs=(fs,)
+        ) as pool:
+            names = [f"/bundle/{n}.txt" for n in range(20)]
+            self.assertEqual(list(pool.map(read_forked, names)), [read_text(fs, name) for name in names])
+            with self.assertRaises(TypeError):
+                pickle.dumps(fs)
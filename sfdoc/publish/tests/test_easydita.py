@@ -0,0 +1,114 @@
+from io import BytesIO
+import hashlib
+import logging
+import os
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from django.test import override_settings
+from test_plus.test import TestCase
+
+from .. import easydita
+from ..exceptions import SfdocError
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+
+@override_settings(
+    EASYDITA_DOWNLOAD_CHUNK_SIZE=1000,
+    EASYDITA_DOWNLOAD_RETRIES=3,
+    EASYDITA_DOWNLOAD_BACKOFF=0,
+)
+class TestDownloadBundle(TestCase):
+    content = bytes(range(256)) * 100
+
+    def download(self, server):
+        zip_file = BytesIO()
+        sha256 = easydita.download_bundle(server.url, zip_file, logger)
+        self.assertEqual(sha256, hashlib.sha256(self.content).hexdigest())
+        return zip_file.getvalue()
+
+    def test_download(self):
+        with utils.FakeBundleServer(self.content) as server:
+            self.assertEqual(self.download(server), self.content)
+        self.assertEqual(server.requests, [None])
+
+    def test_resume(self):
+        with utils.FakeBundleServer(self.content, failures=2, fail_after=10000) as server:
+            with self.assertLogs(logger, "INFO") as logs:
+                self.assertEqual(self.download(server), self.content)
+        self.assertEqual(server.requests, [None, "bytes=10000-", "bytes=20000-"])
+        self.assertIn("with 2 retries", logs.output[-1])
+
+    def test_restart_without_range_support(self):
+        with utils.FakeBundleServer(self.content, failures=1, fail_after=10000, ranges=False) as server:
+            self.assertEqual(self.download(server), self.content)
+        self.assertEqual(server.requests, [None, "bytes=10000-"])
+
+    def test_gives_up(self):
+        with utils.FakeBundleServer(self.content, failures=4, fail_after=10) as server:
+            with self.assertRaises(SfdocError):
+                self.download(server)
+        self.assertEqual(len(server.requests), 4)
+
+    def test_backoff(self):
+        with utils.FakeBundleServer(self.content, failures=3, fail_after=10) as server:
+            with override_settings(EASYDITA_DOWNLOAD_BACKOFF=1, EASYDITA_DOWNLOAD_BACKOFF_MAX=3):
+                with self.assertLogs(logger, "WARNING"), \
+                        mock.patch("sfdoc.publish.easydita.time.sleep") as sleep:
+                    self.download(server)
+        self.assertEqual([c.args[0] for c in sleep.call_args_list], [1, 2, 3])
+
+
+class TestBundleCache(TestCase):
+    def download(self, content):
+        def download(zip_file):
+            zip_file.write(content)
+            return hashlib.sha256(content).hexdigest()
+        return download
+
+    def test_open(self):
+        with TemporaryDirectory() as path:
+            cache = easydita.BundleCache(path, 1000)
+            self.assertIsNone(cache.open("uuid-1"))
+            with cache.add("uuid-1", self.download(b"bundle 1")) as zip_file:
+                self.assertEqual(zip_file.read(), b"bundle 1")
+            with cache.open("uuid-1") as zip_file:
+                self.assertEqual(zip_file.read(), b"bundle 1")
+            self.assertIsNone(cache.open("uuid"))
+
+    def test_corrupt_zip_is_removed(self):
+        with TemporaryDirectory() as path:
+            cache = easydita.BundleCache(path, 1000)
+            cache.add("uuid-1", self.download(b"bundle 1")).close()
+            zip_path = os.path.join(path, os.listdir(path)[0])
+            with open(zip_path, "wb") as f:
+                f.write(b"corrupt")
+            self.assertIsNone(cache.open("uuid-1"))
+            self.assertEqual(os.listdir(path), [])
+
+    def test_failed_download_is_not_cached(self):
+        def download(zip_file):
+            zip_file.write(b"partial")
+            raise SfdocError("failed")
+
+        with TemporaryDirectory() as path:
+            cache = easydita.BundleCache(path, 1000)
+            with self.assertRaises(SfdocError):
+                cache.add("uuid-1", download)
+            self.assertEqual(os.listdir(path), [])
+
+    def test_evicts_least_recently_used(self):
+        with TemporaryDirectory() as path:
+            cache = easydita.BundleCache(path, 20)  # room for two
+            for n, mtime in ((1, 100), (2, 200)):
+                cache.add(f"uuid-{n}", self.download(b"bundle %d" % n)).close()
+                zip_path = os.path.join(path, cache._filenames(f"uuid-{n}")[0])
+                os.utime(zip_path, (mtime, mtime))
+            cache.open("uuid-1").close()  # now more recently used than uuid-2
+            cache.add("uuid-3", self.download(b"bundle 3")).close()
+            self.assertEqual(sorted(os.listdir(path)), sorted(
+                cache._filenames("uuid-1") + cache._filenames("uuid-3")
+            ))
+            self.assertEqual(cache._filenames("uuid-2"), [])
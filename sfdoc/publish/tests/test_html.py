@@ -1,18 +1,30 @@
+import glob
 import os
 import logging
+import sys
 from io import StringIO
+from tempfile import TemporaryDirectory
+from unittest import skipUnless
 from unittest.mock import patch
 
 from test_plus.test import TestCase
 from django.test import override_settings
 from django.conf import settings
+from bs4 import BeautifulSoup
 
-from ..html import HTML, collect_html_paths
+from ..html import HTML, ArticleHeader, ArticleStore, LinkRewriter, collect_html_paths, compare_parsers
+from ..html import record_content_hash
+from .. import utils as publish_utils
 
 from . import utils
 
 rootdir = os.path.abspath(os.path.join(__file__, "../../../.."))
 
+try:
+    import lxml
+except ImportError:  # pragma: no cover
+    lxml = None
+
 
 class TestHTML(TestCase):
 
@@ -25,9 +37,9 @@ class TestHTML(TestCase):
             self.article['body'],
         )
 
-    def html(self, markup):
+    def html(self, markup, htmlpath="foo.html"):
         with patch("builtins.open", new=lambda *args: StringIO(markup)):
-            return HTML("foo.html", "/some/path")
+            return HTML(htmlpath, "/some/path")
 
     def test_init(self):
         html = self.html(self.html_s)
@@ -36,6 +48,15 @@ class TestHTML(TestCase):
         self.assertEqual(html.summary, self.article['summary'])
         self.assertEqual(html.body, self.article['body'])
 
+    @override_settings(HTML_PARSER='lxml')
+    @skipUnless(lxml, "lxml is not installed")
+    def test_init_lxml(self):
+        html = self.html(self.html_s)
+        self.assertEqual(html.url_name, self.article['url_name'])
+        self.assertEqual(html.title, self.article['title'])
+        self.assertEqual(html.body, self.article['body'])
+        self.assertEqual(html.get_image_paths(), {'../images/test-image.png'})
+
     def generate_links(self, count):
         tpl = '<a href="Product_Docs/V4S/topics/{}.html">test</a>'
         return '\n'.join([tpl.format(i) for i in range(count)])
@@ -110,6 +131,45 @@ class TestHTML(TestCase):
         self.assertEqual(sorted(files), sorted(["fC-Documentation.html", "fC-Overview.html", "fC-Release-Notes.html", 
                                                 "fC-FAQ.html", "fC-Guide.html"]))
 
+    @skipUnless(lxml, "lxml is not installed")
+    @override_settings(ARTICLE_AUTHOR="ArticleOwner", ARTICLE_BODY_CLASS="slds-container_large")
+    def test_parser_conformance(self):
+        """html.parser and lxml produce the same payloads for the test bundles."""
+        logger = logging.getLogger("test")
+        for zipfile in sorted(glob.glob(os.path.join(rootdir, "testdata/bundles/*.zip"))):
+            with TemporaryDirectory() as tempdir:
+                publish_utils.unzip(zipfile, tempdir, recursive=True, ignore_patterns=["*/assets/*"])
+                path = publish_utils.find_bundle_root_directory(tempdir)
+                html_files = collect_html_paths(path, logger)
+                self.assertTrue(html_files)
+                # articles that do not parse are reported too
+                self.assertEqual(compare_parsers(html_files, path), [], zipfile)
+                self.assertTrue(HTML(sorted(html_files)[0], path).body)
+
+    def test_update_links_draft_image_urls(self):
+        html = self.html(self.html_s, "/some/path/topics/foo.html")
+        image_urls = {"images/test-image.png": "https://bucket/draft/test-image.png"}
+        with patch("os.path.exists") as exists:
+            html.update_links_draft("uuid", image_urls=image_urls)
+        exists.assert_not_called()
+        self.assertIn('<img src="https://bucket/draft/test-image.png"/>', html.body)
+        with self.assertRaises(AssertionError):
+            self.html(self.html_s, "/some/path/topics/foo.html").update_links_draft("uuid", image_urls={})
+
+    def test_link_rewriter_copies_unchanged_markup(self):
+        source = (
+            '<!-- a comment --><P CLASS="x">caf&eacute; &#233; &amp;</P>\n'
+            '<a href="a.html" class="y">a</a><br>\n<img alt="1 &lt; 2" src="a.png"/>'
+            '<a name="anchor">b</a>'
+        )
+        rewriter = LinkRewriter(lambda href: "/s/" + href, lambda src: "https://x/" + src)
+        self.assertEqual(rewriter.rewrite(source), (
+            '<!-- a comment --><P CLASS="x">caf&eacute; &#233; &amp;</P>\n'
+            '<a href="/s/a.html" class="y">a</a><br>\n<img alt="1 &lt; 2" src="https://x/a.png"/>'
+            '<a name="anchor">b</a>'
+        ))
+        self.assertEqual(LinkRewriter(lambda href: href).rewrite(source), source)
+
     def test_update_links_production(self):
         html = f"""<body><a href="Product_Docs/V4S/topics/Test-Path2.html#foo">test</a>\n
                     <img src="https://dummydomain.s3.amazonaws.com/{settings.AWS_S3_DRAFT_IMG_DIR}/some-uuid/path/img.png"></img>
@@ -119,6 +179,34 @@ class TestHTML(TestCase):
         assert "/draft/" not in updated
         assert "/public/" in updated
 
+    def scrub(self, body):
+        return self.html(utils.create_test_html('test-article', 'Title', 'Summary', body)).scrub()
+
+    def test_scrub(self):
+        problems = self.scrub(
+            '<p><span>a</span><span>b</span></p>'
+            '<p style="x">c</p><img src="http://example.com/a.png"/>'
+        )
+        self.assertEqual(problems, [
+            'Tag "span" not in whitelist (2 times)',
+            'Tag "p" attribute "style" not in whitelist',
+            'URL http://example.com/a.png not whitelisted',
+        ])
+
+    @override_settings(SCRUB_PROBLEM_LIMIT=2)
+    def test_scrub_problem_limit(self):
+        problems = self.scrub('<span></span><span></span><em></em><b></b><i></i>')
+        self.assertEqual(problems, [
+            'Tag "span" not in whitelist (2 times)',
+            'Tag "em" not in whitelist',
+            'Too many problems, stopped scrubbing after 2',
+        ])
+
+    def test_scrub_deeply_nested(self):
+        depth = sys.getrecursionlimit() * 2
+        problems = self.scrub('<div>' * depth + '<span></span>' + '</div>' * depth)
+        self.assertEqual(problems, ['Tag "span" not in whitelist'])
+
     def test_compare(self):
         logger = logging.getLogger("test")
         record = utils.gen_article(1)
@@ -137,3 +225,160 @@ class TestHTML(TestCase):
         record["Title"] = "Foo"
         assert not html.same_as_record(record, logger)
 
+
+    def test_parsed_once(self):
+        logger = logging.getLogger("test")
+        source = utils.create_test_html(
+            'test-article',
+            'Test Article Title',
+            'This is a test summary',
+            '<a href="Product_Docs/V4S/topics/Test-Path.html">test</a>\n'
+            f'<img src="https://dummydomain.s3.amazonaws.com/{settings.AWS_S3_DRAFT_IMG_DIR}some-uuid/img.png"/>',
+        )
+        with patch("sfdoc.publish.html.BeautifulSoup", wraps=BeautifulSoup) as soup:
+            html = self.html(source)
+            html.scrub()
+            html.get_image_paths()
+            self.assertEqual(soup.call_count, 1)
+            record = {"ArticleAuthor__c": html.author,
+                      "ArticleAuthorOverride__c": html.author_override,
+                      "IsVisibleInCsp": html.is_visible_in_csp,
+                      "IsVisibleInPkb": html.is_visible_in_pkb,
+                      "IsVisibleInPrm": html.is_visible_in_prm,
+                      "Title": html.title,
+                      "Summary": html.summary,
+                      "ArticleBody__c": HTML.update_links_production(html.body),
+                      }
+            soup.reset_mock()
+            assert html.same_as_record(record, logger)
+            html.create_article_data()
+        soup.assert_not_called()
+        # comparing with the published version must not modify the draft
+        self.assertIn(settings.AWS_S3_DRAFT_IMG_DIR, html.body)
+
+
+    @override_settings(SALESFORCE_ARTICLE_HASH_FIELD="ContentHash__c")
+    def test_compare_content_hash(self):
+        logger = logging.getLogger("test")
+        html = self.html(self.html_s)
+        data = html.create_article_data()
+        self.assertEqual(data["ContentHash__c"], html.content_hash())
+        # only the hash is needed, not the body
+        record = {"ContentHash__c": data["ContentHash__c"]}
+        assert html.same_as_record(record, logger)
+        assert not html.same_as_record({"ContentHash__c": "0" * 64}, logger)
+        assert not html.same_as_record({"ContentHash__c": None}, logger)
+
+    def test_record_content_hash(self):
+        html = self.html(self.html_s)
+        self.assertEqual(record_content_hash(html.create_article_data()), html.content_hash())
+        record = {**html.create_article_data(), "Title": "Edited in Salesforce"}
+        self.assertNotEqual(record_content_hash(record), html.content_hash())
+
+    def test_content_hash_ignores_draft_location(self):
+        source = utils.create_test_html(
+            'test-article', 'Title', 'Summary',
+            f'<img src="https://bucket.s3.amazonaws.com/{settings.AWS_S3_DRAFT_IMG_DIR}uuid/a.png"/>',
+        )
+        published = utils.create_test_html(
+            'test-article', 'Title', 'Summary',
+            f'<img src="https://bucket.s3.amazonaws.com/{settings.AWS_S3_PUBLIC_IMG_DIR}uuid/a.png"/>',
+        )
+        self.assertEqual(self.html(source).content_hash(), self.html(published).content_hash())
+        changed = self.html(source)
+        changed.title = "New Title"
+        self.assertNotEqual(self.html(source).content_hash(), changed.content_hash())
+
+
+class TestArticleStore(TestCase):
+
+    def html(self, n):
+        article = utils.gen_article(n)
+        markup = utils.create_test_html(
+            article['url_name'],
+            article['title'],
+            article['summary'],
+            article['body'],
+        )
+        with patch("builtins.open", new=lambda *args: StringIO(markup)):
+            return HTML(f"/some/path/{article['filename']}", "/some/path")
+
+    def test_keeps_articles_in_memory(self):
+        html = self.html(1)
+        with ArticleStore("/some/path") as store:
+            store.add(html)
+            self.assertIn(html.htmlpath, store)
+            self.assertEqual(store.memory_used, html.size)
+            # the parsed document is not kept alive
+            self.assertIsNone(html._body_tag)
+            self.assertIs(store.pop(html.htmlpath), html)
+            self.assertEqual(html.get_image_paths(), {"../images/test-image.png"})
+            self.assertNotIn(html.htmlpath, store)
+            self.assertEqual(store.memory_used, 0)
+
+    def test_spills_over_budget(self):
+        html1, html2 = self.html(1), self.html(2)
+        with ArticleStore("/some/path", memory_budget=html1.size) as store:
+            store.add(html1)
+            store.add(html2)
+            self.assertEqual(len(store), 2)
+            self.assertEqual(store.memory_used, html1.size)
+            spilled = store.pop(html2.htmlpath)
+            spill_dir = store._spill_dir.name
+        self.assertIsNot(spilled, html2)
+        self.assertEqual(spilled.url_name, html2.url_name)
+        self.assertEqual(spilled.body, html2.body)
+        self.assertEqual(spilled.get_image_paths(), html2.get_image_paths())
+        self.assertFalse(os.path.exists(spill_dir))
+
+    def test_spill_files_are_not_reused(self):
+        html1, html2, html3 = self.html(1), self.html(2), self.html(3)
+        with ArticleStore("/some/path", memory_budget=0) as store:
+            store.add(html1)
+            store.add(html2)
+            store.pop(html1.htmlpath)
+            store.add(html3)
+            self.assertEqual(store.get(html2.htmlpath).url_name, html2.url_name)
+            self.assertEqual(store.get(html3.htmlpath).url_name, html3.url_name)
+
+
+class TestArticleHeader(TestCase):
+
+    def header(self, markup):
+        with patch("builtins.open", new=lambda *args: StringIO(markup)):
+            return ArticleHeader("foo.html")
+
+    def test_header(self):
+        article = utils.gen_article(1)
+        header = self.header(utils.create_test_html(
+            article['url_name'], 'Fish &amp; Chips', article['summary'], article['body'],
+        ))
+        self.assertEqual(header.url_name, article['url_name'])
+        self.assertEqual(header.title, 'Fish & Chips')
+        self.assertEqual(header.meta['description'], article['summary'])
+        self.assertEqual(header.problems(), [])
+
+    def test_stops_at_body(self):
+        markup = utils.create_test_html('url', 'title', 'summary', '<p>body</p>' * 1000)
+        stream = StringIO(markup)
+        with patch.object(ArticleHeader, "chunk_size", 16), patch("builtins.open", new=lambda *args: stream), \
+                patch.object(stream, "close"):
+            header = ArticleHeader("foo.html")
+        self.assertEqual(header.title, 'title')
+        self.assertLessEqual(stream.tell(), markup.index('<body>') + 2 * 16)
+
+    def test_problems(self):
+        header = self.header('<html><head><meta name="UrlName" content=""></head><body></body></html>')
+        problems = header.problems()
+        self.assertIn('Meta tag name=UrlName has no content in foo.html', problems)
+        self.assertIn('Meta tag name=is-visible-in-csp not found in foo.html', problems)
+        self.assertIn('Article title not found in foo.html', problems)
+
+    def test_same_as_beautifulsoup(self):
+        testdita = os.path.join(rootdir, "testdata/sampledita")
+        for html_file in collect_html_paths(testdita, logging.getLogger("test")):
+            with open(html_file) as f:
+                soup = BeautifulSoup(f.read(), 'html.parser')
+            header = ArticleHeader(html_file)
+            self.assertEqual(header.url_name, soup.find('meta', attrs={'name': 'UrlName'})['content'])
+            self.assertEqual(header.title, soup.title.string)
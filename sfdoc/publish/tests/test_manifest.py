@@ -0,0 +1,111 @@
+import glob
+import hashlib
+import logging
+import os
+from tempfile import TemporaryDirectory
+
+from django.test import override_settings
+from test_plus.test import TestCase
+
+from .. import utils
+from ..bundlefs import DirectoryFS, ZipFS
+from ..html import collect_html_paths
+from ..manifest import BundleDelta, BundleManifest, manifest_record
+from .utils import rootdir
+
+logger = logging.getLogger(__name__)
+IGNORE_PATTERNS = ["*/assets/*"]
+
+
+class TestBundleManifest(TestCase):
+    def relative(self, manifest, paths):
+        return [os.path.relpath(path, manifest.root) for path in paths]
+
+    def test_same_as_separate_walks(self):
+        for zip_path in glob.glob(os.path.join(rootdir, "testdata/bundles/*.zip")):
+            with TemporaryDirectory() as path:
+                utils.unzip(zip_path, path, recursive=True, ignore_patterns=IGNORE_PATTERNS)
+                manifest = BundleManifest.scan(DirectoryFS(path))
+                root = utils.find_bundle_root_directory(path)
+                self.assertEqual(manifest.root, root)
+                self.assertEqual(manifest.html_files, sorted(collect_html_paths(root, logger)))
+                self.assertEqual(len(manifest.index_files), 1)
+                for filename, entry in manifest.files.items():
+                    with open(filename, "rb") as f:
+                        data = f.read()
+                    self.assertEqual(entry.size, len(data))
+                    self.assertEqual(entry.sha256, hashlib.sha256(data).hexdigest())
+
+            with ZipFS(zip_path, ignore_patterns=IGNORE_PATTERNS) as fs:
+                zipped = BundleManifest.scan(fs)
+            self.assertEqual(zipped.hashes(), manifest.hashes())
+            self.assertEqual(self.relative(zipped, zipped.images), self.relative(manifest, manifest.images))
+
+    @override_settings(SKIP_HTML_FILES=["skip*.html"])
+    def test_scan(self):
+        with TemporaryDirectory() as path:
+            root = os.path.join(path, "bundle")
+            for name in ("log.txt", "index.html", "topics/a.html", "topics/skip-me.html", "images/a.PNG"):
+                os.makedirs(os.path.dirname(os.path.join(root, name)), exist_ok=True)
+                with open(os.path.join(root, name), "w") as f:
+                    f.write(name)
+            with open(os.path.join(path, "outside.html"), "w") as f:
+                f.write("not in the bundle")
+
+            manifest = BundleManifest.scan(DirectoryFS(path))
+            self.assertEqual(manifest.root, root)
+            self.assertEqual(self.relative(manifest, manifest.index_files), ["index.html"])
+            self.assertEqual(self.relative(manifest, manifest.html_files), ["index.html", "topics/a.html"])
+            self.assertEqual(self.relative(manifest, manifest.skipped_files), ["topics/skip-me.html"])
+            self.assertEqual(self.relative(manifest, manifest.images), ["images/a.PNG"])
+            self.assertTrue(manifest.exists(os.path.join(root, "topics/../images/a.PNG")))
+            self.assertFalse(manifest.exists(os.path.join(path, "outside.html")))
+            self.assertEqual(manifest.hashes()["log.txt"], hashlib.sha256(b"log.txt").hexdigest())
+
+            # scanning from below the root finds it above
+            below = BundleManifest.scan(DirectoryFS(path), os.path.join(root, "topics"))
+            self.assertEqual(below.root, root)
+            self.assertEqual(below.hashes(), manifest.hashes())
+
+
+class TestBundleDelta(TestCase):
+    def write(self, root, files):
+        for name, content in files.items():
+            os.makedirs(os.path.dirname(os.path.join(root, name)), exist_ok=True)
+            with open(os.path.join(root, name), "w") as f:
+                f.write(content)
+
+    def scan(self, path, files):
+        self.write(path, dict(files, **{"log.txt": "log"}))
+        return BundleManifest.scan(DirectoryFS(path))
+
+    def test_delta(self):
+        with TemporaryDirectory() as old_path, TemporaryDirectory() as new_path:
+            old = self.scan(old_path, {
+                "a.html": "a", "b.html": "b", "c.html": "c", "gone.html": "gone", "images/old.png": "png",
+            })
+            articles = {
+                os.path.join(old_path, "a.html"): ("a", set()),
+                os.path.join(old_path, "b.html"): ("b", set()),
+                os.path.join(old_path, "c.html"): ("c", {os.path.join(old_path, "images/new.png")}),
+                os.path.join(old_path, "gone.html"): ("gone", {os.path.join(old_path, "images/old.png")}),
+            }
+            record = manifest_record(old, articles, "fingerprint")
+            new = self.scan(new_path, {
+                "a.html": "a", "b.html": "b changed", "c.html": "c", "d.html": "d", "images/new.png": "png",
+            })
+
+            delta = BundleDelta(new, record, "fingerprint")
+            self.assertEqual(delta.unchanged, {"log.txt", "a.html", "c.html"})
+            self.assertEqual(delta.changed, {"b.html"})
+            self.assertEqual(delta.added, {"d.html", "images/new.png"})
+            self.assertEqual(delta.removed, {"gone.html", "images/old.png"})
+            self.assertEqual(delta.unchanged_article(os.path.join(new_path, "a.html")), ("a", set()))
+            self.assertIsNone(delta.unchanged_article(os.path.join(new_path, "b.html")))
+            # its image appeared, so its links change
+            self.assertIsNone(delta.unchanged_article(os.path.join(new_path, "c.html")))
+            self.assertIsNone(delta.unchanged_article(os.path.join(new_path, "d.html")))
+
+            other_settings = BundleDelta(new, record, "other fingerprint")
+            self.assertEqual(other_settings.unchanged, set())
+            self.assertEqual(len(other_settings.added), 6)
@@ -1,3 +1,4 @@
+import json
 from urllib.parse import urljoin
 
 from unittest import skip, mock
@@ -10,7 +11,9 @@ import responses
 from test_plus.test import TestCase
 import pytest
 
-from ..salesforce import SalesforceArticles, sf_api_logger, get_community_base_url
+from ..exceptions import SalesforceError
+from ..html import record_content_hash
+from ..salesforce import ArticleRecords, SalesforceArticles, sf_api_logger, get_community_base_url
 from .utils import create_test_html
 from simple_salesforce import exceptions as SimpleSalesforceExceptions
 
@@ -90,6 +93,252 @@ class TestSalesforceArticles(TestCase):
             assert "OldDocsetId" in error_logger.mock_calls[2][1][0]
             assert "FakeUUID" in error_logger.mock_calls[3][1][0]
 
+class TestDraftWriter(TestCase):
+    instance_url = 'https://testinstance.salesforce.com'
+
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.bundle = Bundle.objects.create(easydita_resource_id="pretend_UUID")
+
+    def html(self, url_name):
+        html_file = Path(self.tempdir.name) / f"{url_name}.html"
+        html_file.write_text(create_test_html(url_name, "title", "summary", "body"))
+        return HTML(str(html_file), self.tempdir.name)
+
+    def write_drafts(self, htmls, drafts, online):
+        salesforce = get_salesforce_instance(self.instance_url, False)
+
+        def query_articles_cached(publish_status, UrlName):
+            records = drafts if publish_status == "draft" else online
+            return [record for record in records if record["UrlName"] == UrlName]
+
+        with mock.patch.object(salesforce, "query_articles_cached", query_articles_cached), \
+                mock.patch.object(type(salesforce), "sf_docset", {"Id": "docset"}), \
+                mock.patch.object(salesforce, "create_draft", return_value="new-draft") as create_draft, \
+                mock.patch.object(salesforce, "save_article") as save_article, \
+                mock.patch.object(salesforce, "fetch_bodies") as fetch_bodies, \
+                mock.patch.object(HTML, "same_as_record", return_value=False):
+            try:
+                with salesforce.draft_writer(self.bundle) as writer:
+                    for html in htmls:
+                        writer.add(html)
+            finally:
+                self.create_draft = create_draft
+                self.fetch_bodies = fetch_bodies
+                self.saved = [(call[1][0], call[1][3]) for call in save_article.mock_calls]
+
+    @responses.activate
+    @override_settings(SALESFORCE_API_VERSION="42.0")
+    def test_collections(self):
+        url = self.instance_url + '/services/data/v42.0/composite/sobjects'
+        responses.add('POST', url, json=[{"id": "created", "success": True, "errors": []}])
+        responses.add('PATCH', url, json=[
+            {"id": "draft", "success": True, "errors": []},
+            {"success": False, "errors": [{"statusCode": "INVALID_FIELD", "message": "bad", "fields": []}]},
+        ])
+        htmls = [self.html("new"), self.html("drafted"), self.html("published")]
+        with pytest.raises(SalesforceError) as e:
+            self.write_drafts(
+                htmls,
+                drafts=[{"Id": "draft", "UrlName": "drafted"}],
+                online=[{"Id": "online", "KnowledgeArticleId": "ka", "UrlName": "published"}],
+            )
+        # the failed record is reported with its HTML file
+        assert f"{htmls[2].htmlpath}: INVALID_FIELD: bad" in str(e.value)
+        self.create_draft.assert_called_once_with("ka", fetch=False)
+        assert self.saved == [("created", Article.STATUS_NEW), ("draft", Article.STATUS_NEW)]
+        assert len(responses.calls) == 3
+        records = json.loads(responses.calls[1].request.body)["records"]
+        assert records[0]["attributes"] == {"type": settings.SALESFORCE_ARTICLE_TYPE}
+        assert records[0][settings.SALESFORCE_DOCSET_RELATION_FIELD] == "docset"
+        assert [record["Id"] for record in json.loads(responses.calls[2].request.body)["records"]] == [
+            "draft", "new-draft",
+        ]
+
+    @responses.activate
+    @override_settings(SALESFORCE_API_VERSION="41.0", SALESFORCE_DRAFT_BATCH_SIZE=1)
+    def test_composite(self):
+        responses.add('POST', self.instance_url + '/services/data/v41.0/composite', json={"compositeResponse": [
+            {"body": {"id": "created", "success": True, "errors": []}, "httpStatusCode": 201, "referenceId": "record0"},
+        ]})
+        responses.add('POST', self.instance_url + '/services/data/v41.0/composite', json={"compositeResponse": [
+            {"body": None, "httpStatusCode": 204, "referenceId": "record0"},
+        ]})
+        self.write_drafts(
+            [self.html("new"), self.html("drafted")],
+            drafts=[{"Id": "draft", "UrlName": "drafted"}],
+            online=[],
+        )
+        assert self.saved == [("created", Article.STATUS_NEW), ("draft", Article.STATUS_NEW)]
+        update = json.loads(responses.calls[2].request.body)["compositeRequest"][0]
+        assert update["method"] == "PATCH"
+        assert update["url"] == f"/services/data/v41.0/sobjects/{settings.SALESFORCE_ARTICLE_TYPE}/draft"
+        assert "Id" not in update["body"]
+
+    @responses.activate
+    @override_settings(SALESFORCE_API_VERSION="42.0")
+    def test_payload_built_once(self):
+        url = self.instance_url + '/services/data/v42.0/composite/sobjects'
+        responses.add('POST', url, json=[{"id": "created", "success": True, "errors": []}])
+        responses.add('PATCH', url, json=[{"id": "draft", "success": True, "errors": []}])
+        with mock.patch.object(HTML, "create_article_data", autospec=True,
+                               side_effect=lambda html: {"UrlName": html.url_name}) as create_article_data:
+            self.write_drafts(
+                [self.html("new"), self.html("drafted")],
+                drafts=[{"Id": "draft", "UrlName": "drafted"}],
+                online=[],
+            )
+        assert create_article_data.call_count == 2
+
+    @responses.activate
+    @override_settings(SALESFORCE_API_VERSION="42.0")
+    def test_published_hash(self):
+        url = self.instance_url + '/services/data/v42.0/composite/sobjects'
+        responses.add('PATCH', url, json=[{"id": "new-draft", "success": True, "errors": []}] * 2)
+        # the published versions were published by sfdoc, their hashes are known
+        published = Bundle.objects.create(easydita_resource_id="pretend_UUID", status=Bundle.STATUS_PUBLISHED)
+        same = self.html("same")
+        Article.objects.create(bundle=published, ka_id="ka1", kav_id="online1", url_name="same",
+                               status=Article.STATUS_NEW, content_hash=same.content_hash(),
+                               published_hash=same.content_hash())
+        # the draft was edited in Salesforce before it was published
+        Article.objects.create(bundle=published, ka_id="ka3", kav_id="online3", url_name="edited",
+                               status=Article.STATUS_NEW, content_hash=self.html("edited").content_hash(),
+                               published_hash="0" * 64)
+        self.write_drafts(
+            [same, self.html("other"), self.html("edited")],
+            drafts=[],
+            online=[{"Id": "online1", "KnowledgeArticleId": "ka1", "UrlName": "same"},
+                    {"Id": "online2", "KnowledgeArticleId": "ka2", "UrlName": "other"},
+                    {"Id": "online3", "KnowledgeArticleId": "ka3", "UrlName": "edited"}],
+        )
+        # only the article of unknown hash is compared with its body
+        assert [record["Id"] for record in self.fetch_bodies.call_args[0][0]] == ["online2"]
+        assert self.create_draft.call_args_list == [mock.call("ka2", fetch=False), mock.call("ka3", fetch=False)]
+
+
+class TestArticleRecords(TestCase):
+    def test_indexes(self):
+        records = ArticleRecords([
+            {"Id": "kav1", "KnowledgeArticleId": "ka1", "UrlName": "First", "Title": "one"},
+            {"Id": "kav2", "KnowledgeArticleId": "ka1", "UrlName": "first", "Title": "two"},
+            {"Id": "kav3", "KnowledgeArticleId": "ka3", "UrlName": "third", "Title": "three"},
+        ])
+        assert len(records) == 3
+        # the UrlName index is case-folded, the match is exact
+        assert [r["Id"] for r in records.find(UrlName="first")] == ["kav2"]
+        assert [r["Id"] for r in records.find(KnowledgeArticleId="ka1")] == ["kav1", "kav2"]
+        assert [r["Id"] for r in records.find(KnowledgeArticleId="ka1", Title="one")] == ["kav1"]
+        assert records.find(Id="missing") == []
+
+        records.update("kav3", {"UrlName": "renamed", "NotCached__c": "x"})
+        assert records.find(UrlName="third") == []
+        assert records.find(UrlName="renamed") == [
+            {"Id": "kav3", "KnowledgeArticleId": "ka3", "UrlName": "renamed", "Title": "three"},
+        ]
+
+        records.remove("kav1")
+        assert [r["Id"] for r in records.find(KnowledgeArticleId="ka1")] == ["kav2"]
+        assert [r["Id"] for r in records.find()] == ["kav2", "kav3"]
+
+
+class TestArticleCache(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(SalesforceArticles, "api", mock.MagicMock())
+        self.api = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.api.base_url = "https://testinstance.salesforce.com/services/data/v41.0/"
+        self.api._call_salesforce.return_value.status_code = 204
+        self.salesforce = SalesforceArticles("pretend_UUID")
+        self.draft = {"Id": "draft", "KnowledgeArticleId": "ka", "UrlName": "article", "Title": "Old",
+                      settings.SALESFORCE_ARTICLE_BODY_FIELD: "draft body"}
+        self.online = {"Id": "online", "KnowledgeArticleId": "ka", "UrlName": "article", "Title": "Old"}
+        SalesforceArticles.invalidate_cache()
+        self.addCleanup(SalesforceArticles.invalidate_cache)
+        SalesforceArticles._article_cache.update({
+            ("pretend_UUID", "draft"): ArticleRecords([dict(self.draft)]),
+            ("pretend_UUID", "online"): ArticleRecords([dict(self.online)]),
+        })
+
+    def test_update_draft(self):
+        html = mock.Mock()
+        html.create_article_data.return_value = {"Title": "New", "NotQueried__c": "x"}
+        self.api.Resource__kav.update.return_value = 204
+        with override_settings(SALESFORCE_ARTICLE_TYPE="Resource__kav"):
+            self.salesforce.update_draft("draft", html)
+        assert self.salesforce.get_by_kav_id("draft", "draft") == {**self.draft, "Title": "New"}
+        self.api.query_all.assert_not_called()
+
+    def test_create_article_fetches_new_record(self):
+        new = {"Id": "new", "KnowledgeArticleId": "new-ka", "UrlName": "new"}
+        self.api.query_all.return_value = {"totalSize": 1, "records": [new]}
+        self.api.Resource__kav.create.return_value = {"id": "new"}
+        html = mock.Mock()
+        html.create_article_data.return_value = {"UrlName": "new"}
+        with override_settings(SALESFORCE_ARTICLE_TYPE="Resource__kav"), \
+                mock.patch.object(type(self.salesforce), "sf_docset", {"Id": "docset"}):
+            self.salesforce.create_article(html)
+        assert "Id IN ('new')" in self.api.query_all.call_args[0][0]
+        assert self.salesforce.get_ka_id("new", "draft") == "new-ka"
+        assert self.salesforce.get_by_kav_id("draft", "draft") == self.draft
+
+    def test_publish_and_archive(self):
+        self.salesforce.set_publish_status("draft", "online")
+        assert self.salesforce.get_articles("draft") == []
+        assert [record["Id"] for record in self.salesforce.get_articles("online")] == ["draft"]
+        assert self.salesforce.get_articles("online")[0]["PublishStatus"] == "Online"
+
+        self.salesforce.set_publish_status("draft", "archived")
+        assert self.salesforce.get_articles("online") == []
+        self.api.query_all.assert_not_called()
+
+    def test_delete(self):
+        self.salesforce.delete("draft")
+        assert self.salesforce.get_articles("draft") == []
+        self.api.query_all.assert_not_called()
+
+    def test_bodies_are_not_cached_up_front(self):
+        SalesforceArticles.invalidate_cache()
+        self.api.query_all.return_value = {"totalSize": 0, "records": []}
+        self.salesforce.get_articles("draft")
+        assert settings.SALESFORCE_ARTICLE_BODY_FIELD not in self.api.query_all.call_args[0][0]
+
+    def test_fetch_bodies_in_batches(self):
+        body_field = settings.SALESFORCE_ARTICLE_BODY_FIELD
+        records = [{"Id": f"kav{n}"} for n in range(3)] + [{"Id": "fetched", body_field: "kept"}]
+        self.api.query_all.side_effect = [
+            {"totalSize": 2, "records": [{"Id": "kav0", body_field: "0"}, {"Id": "kav1", body_field: "1"}]},
+            {"totalSize": 1, "records": [{"Id": "kav2", body_field: "2"}]},
+        ]
+        with mock.patch.object(SalesforceArticles, "FETCH_LIMIT", 2):
+            self.salesforce.fetch_bodies(records, "online")
+        assert [record[body_field] for record in records] == ["0", "1", "2", "kept"]
+        assert self.api.query_all.call_count == 2
+        assert "Id IN ('kav0','kav1')" in self.api.query_all.call_args_list[0][0][0]
+
+    def test_publish_draft_fetches_body(self):
+        del SalesforceArticles._article_cache[("pretend_UUID", "draft")]._by_id["draft"][
+            settings.SALESFORCE_ARTICLE_BODY_FIELD]
+        self.api.query_all.return_value = {
+            "totalSize": 1, "records": [{"Id": "draft", settings.SALESFORCE_ARTICLE_BODY_FIELD: "draft body"}],
+        }
+        self.api.Resource__kav.update.return_value = 204
+        with override_settings(SALESFORCE_ARTICLE_TYPE="Resource__kav"):
+            self.salesforce.publish_draft("draft")
+        assert self.api.query_all.call_count == 1
+
+    def test_publish_draft_stores_published_hash(self):
+        bundle = Bundle.objects.create(easydita_resource_id="pretend_UUID")
+        Article.objects.create(bundle=bundle, ka_id="ka", kav_id="draft", url_name="article",
+                               status=Article.STATUS_NEW, content_hash="drafted")
+        self.api.Resource__kav.update.return_value = 204
+        with override_settings(SALESFORCE_ARTICLE_TYPE="Resource__kav"):
+            self.salesforce.publish_draft("draft")
+        # of the draft as it was in Salesforce
+        assert Article.objects.get().published_hash == record_content_hash(self.draft)
+
+
 class TestCommunityUrl(TestCase):
 
     @responses.activate
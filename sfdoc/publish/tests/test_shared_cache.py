@@ -0,0 +1,109 @@
+import fnmatch
+from unittest import mock
+
+from django.conf import settings
+from django.test import override_settings
+from test_plus.test import TestCase
+
+from ..admin import DocsetAdmin
+from ..models import Docset
+from ..salesforce import SalesforceArticles
+from ..shared_cache import SharedArticleCache
+
+
+class FakeRedis:
+    """The few Redis commands SharedArticleCache uses, in a dict."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, pattern):
+        return [key for key in self.data if fnmatch.fnmatch(key, pattern)]
+
+
+@override_settings(SALESFORCE_SHARED_CACHE=True)
+class TestSharedArticleCache(TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch(
+            "sfdoc.publish.salesforce.get_shared_article_cache",
+            lambda: SharedArticleCache(self.redis),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(SalesforceArticles, "api", mock.MagicMock())
+        self.api = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.api.query_all.side_effect = self.query_all
+        self.queries = []
+        self.server = {
+            "kav1": {"Id": "kav1", "UrlName": "one", "SystemModstamp": "2020-01-01"},
+            "kav2": {"Id": "kav2", "UrlName": "two", "SystemModstamp": "2020-01-01"},
+        }
+        SalesforceArticles.invalidate_cache()
+        self.addCleanup(SalesforceArticles.invalidate_cache)
+
+    def query_all(self, query_str):
+        self.queries.append(query_str)
+        records = list(self.server.values())
+        if "Id IN (" in query_str:
+            records = [record for record in records if f"'{record['Id']}'" in query_str]
+        if query_str.startswith("SELECT Id,SystemModstamp "):
+            records = [{"Id": record["Id"], "SystemModstamp": record["SystemModstamp"]} for record in records]
+        return {"totalSize": len(records), "records": records}
+
+    def articles(self):
+        # a job in another worker, which starts with an empty local cache
+        SalesforceArticles.invalidate_cache()
+        self.queries = []
+        return SalesforceArticles("docset").get_articles("draft")
+
+    def test_changed_records_are_queried(self):
+        assert self.articles() == list(self.server.values())
+        assert len(self.queries) == 1
+
+        self.server["kav2"] = {"Id": "kav2", "UrlName": "two", "SystemModstamp": "2020-01-02"}
+        self.server["kav3"] = {"Id": "kav3", "UrlName": "three", "SystemModstamp": "2020-01-02"}
+        del self.server["kav1"]
+        assert sorted(self.articles(), key=lambda record: record["Id"]) == list(self.server.values())
+        assert self.queries[0].startswith("SELECT Id,SystemModstamp ")
+        assert "Id IN ('kav2','kav3')" in self.queries[1]
+
+        assert self.articles()
+        assert len(self.queries) == 1
+
+    @override_settings(SALESFORCE_SHARED_CACHE_CHECK_AFTER=60)
+    def test_writes_make_records_stale(self):
+        self.articles()
+        assert self.articles() == list(self.server.values())
+        assert self.queries == []
+
+        salesforce = SalesforceArticles("docset")
+        getattr(self.api, settings.SALESFORCE_ARTICLE_TYPE).update.return_value = 204
+        salesforce.update_draft("kav1", mock.Mock(create_article_data=mock.Mock(return_value={})))
+        self.articles()
+        assert len(self.queries) == 1
+
+    def test_invalidate(self):
+        self.articles()
+        Docset.objects.create(docset_id="docset")
+        docset_admin = DocsetAdmin(Docset, mock.Mock())
+        with mock.patch("sfdoc.publish.admin.get_shared_article_cache", lambda: SharedArticleCache(self.redis)), \
+                mock.patch.object(docset_admin, "message_user"):
+            docset_admin.clear_shared_article_cache(mock.Mock(), Docset.objects.all())
+        assert list(self.redis.data) == ["sfdoc:articles:docset:version"]
+        self.articles()
+        assert not self.queries[0].startswith("SELECT Id,SystemModstamp ")
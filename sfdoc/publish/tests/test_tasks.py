@@ -1,7 +1,25 @@
+import base64
+import hashlib
+from io import BytesIO
+import json
+import os
+from tempfile import TemporaryDirectory
+from zipfile import ZipFile
+
+from django.db.models import F
+from django.test import override_settings
+import responses
 from test_plus.test import TestCase
 from unittest import mock
 from .factories import BundleFactory
+from . import utils
 from .. import tasks
+from .. import utils as publish_utils
+from ..bundlefs import DirectoryFS, ZipFS, local_fs
+from ..exceptions import SfdocError
+from ..html import collect_html_paths
+from ..manifest import BundleManifest
+from ..models import Article
 from ..models import Bundle
 
 
@@ -17,6 +35,7 @@ class TestTasks(TestCase):
             mock_method.assert_has_calls([call(bundle1.pk), call(bundle2.pk), call(bundle3.pk)], any_order=True)
             [bundle1, bundle2, bundle3]  # unused vars. Shut up linter
 
+    @override_settings(BUNDLE_PREFETCH=True)
     def test_process_bundle_queues_complex_case(self):
         with mock.patch('sfdoc.publish.tasks.process_bundle.delay') as mock_method:
             bundle1 = BundleFactory(status=Bundle.STATUS_QUEUED)
@@ -31,11 +50,246 @@ class TestTasks(TestCase):
             assert mock_method.call_count == 3
             mock_method.assert_has_calls([call(bundle1.pk), call(bundle2.pk), call(bundle3.pk)], any_order=True)
 
-        with mock.patch('sfdoc.publish.tasks.process_bundle.delay') as mock_method:
+        with mock.patch('sfdoc.publish.tasks.process_bundle.delay') as mock_method, \
+                mock.patch('sfdoc.publish.tasks.prefetch_bundle.delay') as mock_prefetch:
             bundle4 = BundleFactory(status=Bundle.STATUS_QUEUED, easydita_resource_id=bundle1.easydita_resource_id)
             bundle5 = BundleFactory(status=Bundle.STATUS_QUEUED, easydita_resource_id=bundle2.easydita_resource_id)
             bundle6 = BundleFactory(status=Bundle.STATUS_QUEUED, easydita_resource_id=bundle3.easydita_resource_id)
             tasks.process_bundle_queues()
             mock_method.assert_not_called()
+            # the blocked docsets get their next bundle ready
+            assert mock_prefetch.call_count == 3
+            assert mock_prefetch.call_args[1] == {"job_id": f"prefetch_bundle_{mock_prefetch.call_args[0][0]}"}
+            # only once, even if the bundles have problems and no manifest
+            tasks.process_bundle_queues()
+            assert mock_prefetch.call_count == 3
 
             [bundle1, bundle2, bundle3, bundle4, bundle5, bundle6]  # unused vars. Shut up linter
+
+
+class TestScrubHtmlFiles(TestCase):
+    def write_articles(self, path, count):
+        html_files = []
+        for n in range(1, count + 1):
+            article = utils.gen_article(n)
+            html_file = os.path.join(path, article['filename'])
+            with open(html_file, "w") as f:
+                f.write(utils.create_test_html(
+                    article['url_name'],
+                    article['title'],
+                    article['summary'],
+                    article['body'] + '<span>not allowed</span>',
+                ))
+            html_files.append(html_file)
+        return html_files
+
+    def scrub(self, bundle, html_files, path, fs=local_fs):
+        return [
+            (html.url_name, problems, image_paths)
+            for html, problems, image_paths in tasks._scrub_html_files(bundle.docset_id, html_files, path, fs)
+        ]
+
+    def test_parallel_results_match_serial(self):
+        bundle = BundleFactory()
+        with TemporaryDirectory() as path:
+            html_files = self.write_articles(path, 5)
+            with override_settings(SCRUB_WORKERS=1):
+                serial = self.scrub(bundle, html_files, path)
+            with override_settings(SCRUB_WORKERS=3):
+                parallel = self.scrub(bundle, html_files, path)
+        self.assertEqual(len(serial), 5)
+        self.assertEqual(serial, parallel)
+        self.assertEqual(serial[0][0], "test-1-url-name")
+        self.assertEqual(serial[0][1], ['Tag "span" not in whitelist'])
+        self.assertEqual(serial[0][2], {os.path.join(os.path.dirname(path), "images/test-image.png")})
+
+    def test_zip_results_match_directory(self):
+        bundle = BundleFactory()
+        with TemporaryDirectory() as path:
+            os.makedirs(os.path.join(path, "unzipped"))
+            html_files = self.write_articles(os.path.join(path, "unzipped"), 5)
+            zip_path = os.path.join(path, "bundle.zip")
+            with ZipFile(zip_path, "w") as f:
+                for html_file in html_files:
+                    f.write(html_file, os.path.basename(html_file))
+            with ZipFS(zip_path, root="/bundle") as fs, override_settings(SCRUB_WORKERS=3):
+                zipped = self.scrub(bundle, sorted(collect_html_paths("/bundle", None, fs)), "/bundle", fs)
+            unzipped = self.scrub(bundle, sorted(html_files), os.path.join(path, "unzipped"))
+        self.assertEqual([result[:2] for result in zipped], [result[:2] for result in unzipped])
+        self.assertEqual(zipped[0][2], {"/images/test-image.png"})
+
+
+class TestDownloadEasyditaBundle(TestCase):
+    content = b"PK fake zip content" * 1000
+
+    def download(self, **headers):
+        bundle = BundleFactory()
+        responses.add(responses.GET, bundle.url, body=self.content, headers=headers)
+        zip_file = BytesIO()
+        with override_settings(EASYDITA_DOWNLOAD_CHUNK_SIZE=1000):
+            sha256 = tasks._download_easydita_bundle(bundle, zip_file)
+        return zip_file.getvalue(), sha256
+
+    @responses.activate
+    def test_download(self):
+        md5 = base64.b64encode(hashlib.md5(self.content).digest()).decode()
+        data, sha256 = self.download(**{"Content-MD5": md5})
+        self.assertEqual(data, self.content)
+        self.assertEqual(sha256, hashlib.sha256(self.content).hexdigest())
+
+    @responses.activate
+    def test_checksum_mismatch(self):
+        md5 = base64.b64encode(hashlib.md5(b"other").digest()).decode()
+        with self.assertRaises(SfdocError):
+            self.download(**{"Content-MD5": md5})
+
+    @responses.activate
+    def test_unpack_from_cache(self):
+        bundle = BundleFactory()
+        zip_buff = BytesIO()
+        with ZipFile(zip_buff, "w") as f:
+            f.writestr("bundle/log.txt", "log")
+        responses.add(responses.GET, bundle.url, body=zip_buff.getvalue())
+        with TemporaryDirectory() as cache_dir, override_settings(BUNDLE_CACHE_DIR=cache_dir):
+            for _ in range(2):
+                with TemporaryDirectory() as path:
+                    tasks._download_and_unpack_easydita_bundle(bundle, path)
+                    self.assertTrue(os.path.exists(os.path.join(path, "bundle/log.txt")))
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_open_bundle_fs_zip(self):
+        bundle = BundleFactory()
+        zip_buff = BytesIO()
+        with ZipFile(zip_buff, "w") as f:
+            f.writestr("bundle/log.txt", "log")
+            f.writestr("bundle/assets/ignored.txt", "ignored")
+        responses.add(responses.GET, bundle.url, body=zip_buff.getvalue())
+        with TemporaryDirectory() as path, override_settings(BUNDLE_FILESYSTEM="zip", BUNDLE_CACHE_SIZE=0):
+            with tasks._open_bundle_fs(bundle, path) as fs:
+                self.assertEqual(publish_utils.find_bundle_root_directory(fs.root, fs), fs.root + "/bundle")
+                self.assertFalse(fs.exists(fs.root + "/bundle/assets/ignored.txt"))
+            self.assertEqual(os.listdir(path), ["bundle.zip"])
+
+
+@override_settings(BUNDLE_DELTA_DETECTION=True)
+class TestBundleDelta(TestCase):
+    def write_bundle(self, path, bodies):
+        with open(os.path.join(path, "log.txt"), "w") as f:
+            f.write("log")
+        os.makedirs(os.path.join(path, "images"))
+        with open(os.path.join(path, "images/test-image.png"), "wb") as f:
+            f.write(b"png")
+        os.makedirs(os.path.join(path, "topics"))
+        for n, body in enumerate(bodies, start=1):
+            article = utils.gen_article(n)
+            with open(os.path.join(path, "topics", article["filename"]), "w") as f:
+                f.write(utils.create_test_html(article["url_name"], article["title"], article["summary"], body))
+
+    def create_drafts(self, bundle, path, online=None):
+        """online lists the url_names online in Salesforce, by default the
+        articles of published bundles."""
+        manifest = BundleManifest.scan(local_fs, path)
+        salesforce_docset = mock.MagicMock()
+        salesforce_docset.get_articles.return_value = []
+        if online is None:
+            online = Article.objects.filter(bundle__status=Bundle.STATUS_PUBLISHED).values_list("url_name", flat=True)
+        salesforce_docset.find_articles_by_name.side_effect = lambda url_name, status: (
+            [{"Id": f"kav-{url_name}"}] if status == "online" and url_name in online else []
+        )
+        drafts = salesforce_docset.draft_writer.return_value.__enter__.return_value
+        drafts.add.side_effect = lambda html: Article.objects.create(
+            bundle=bundle, url_name=html.url_name, kav_id=f"kav-{html.url_name}", status=Article.STATUS_NEW,
+            content_hash=html.content_hash(),
+        )
+        s3 = mock.Mock()
+        s3.iter_objects.return_value = []
+        tasks.create_drafts(bundle, manifest.html_files, manifest.root, salesforce_docset, s3, local_fs, manifest)
+        bundle.save()
+        return (
+            [call.args[0].url_name for call in drafts.add.call_args_list],
+            [os.path.relpath(call.args[0], path) for call in s3.process_image.call_args_list],
+        )
+
+    def publish(self, bundle):
+        docset = bundle.docset
+        docset.published_manifest = bundle.manifest
+        docset.save()
+        bundle.status = Bundle.STATUS_PUBLISHED
+        bundle.save()
+        # as publish_draft does for drafts that were not edited in Salesforce
+        bundle.articles.update(published_hash=F("content_hash"))
+
+    def test_only_delta_is_processed(self):
+        image = '<img src="../images/test-image.png"/>'
+        with TemporaryDirectory() as path:
+            self.write_bundle(path, ["one", "two " + image, "three"])
+            bundle = BundleFactory()
+            self.assertEqual(self.create_drafts(bundle, path), (
+                ["test-1-url-name", "test-2-url-name", "test-3-url-name"], ["images/test-image.png"],
+            ))
+            self.publish(bundle)
+
+        with TemporaryDirectory() as path:
+            self.write_bundle(path, ["one", "two " + image, "three changed " + image])
+            bundle = BundleFactory(easydita_resource_id=bundle.easydita_resource_id)
+            self.assertEqual(self.create_drafts(bundle, path), (
+                ["test-3-url-name"], ["images/test-image.png"],
+            ))
+            # unchanged articles are kept in the manifest for the next bundle
+            self.assertEqual(
+                sorted(json.loads(bundle.manifest)["articles"]),
+                ["topics/test1.html", "topics/test2.html", "topics/test3.html"],
+            )
+
+            with override_settings(BUNDLE_DELTA_DETECTION=False):
+                bundle = BundleFactory(easydita_resource_id=bundle.easydita_resource_id)
+                self.assertEqual(len(self.create_drafts(bundle, path)[0]), 3)
+
+            # archived in Salesforce since it was published
+            bundle = BundleFactory(easydita_resource_id=bundle.easydita_resource_id)
+            self.assertEqual(
+                self.create_drafts(bundle, path, online=["test-1-url-name"])[0],
+                ["test-2-url-name", "test-3-url-name"],
+            )
+
+
+    def test_draft_edited_before_publishing(self):
+        with TemporaryDirectory() as path:
+            self.write_bundle(path, ["one", "two"])
+            bundle = BundleFactory()
+            self.create_drafts(bundle, path)
+            self.publish(bundle)
+            bundle.articles.filter(url_name="test-2-url-name").update(published_hash="0" * 64)
+            bundle = BundleFactory(easydita_resource_id=bundle.easydita_resource_id)
+            self.assertEqual(self.create_drafts(bundle, path)[0], ["test-2-url-name"])
+
+
+class TestPrefetchBundle(TestBundleDelta):
+    def prefetch(self, bundle, path):
+        with mock.patch("sfdoc.publish.tasks._open_bundle_fs", return_value=DirectoryFS(path)):
+            tasks.prefetch_bundle(bundle.pk)
+        bundle.refresh_from_db()
+
+    def test_prefetched_articles_are_not_scrubbed_again(self):
+        with TemporaryDirectory() as path:
+            self.write_bundle(path, ["one", "two"])
+            bundle = BundleFactory(status=Bundle.STATUS_QUEUED)
+            self.prefetch(bundle, path)
+            self.assertEqual(
+                sorted(json.loads(bundle.manifest)["articles"]),
+                ["topics/test1.html", "topics/test2.html"],
+            )
+
+            with mock.patch("sfdoc.publish.tasks._scrub_and_analyze_html") as scrub:
+                url_names, images = self.create_drafts(bundle, path)
+            scrub.assert_not_called()
+            self.assertEqual(url_names, ["test-1-url-name", "test-2-url-name"])
+
+    def test_problems_are_left_to_processing(self):
+        with TemporaryDirectory() as path:
+            self.write_bundle(path, ["one", "<blink>two</blink>"])
+            bundle = BundleFactory(status=Bundle.STATUS_QUEUED)
+            self.prefetch(bundle, path)
+            self.assertEqual(bundle.manifest, "")
+            self.assertEqual(bundle.status, Bundle.STATUS_QUEUED)
@@ -1,4 +1,6 @@
+from io import BytesIO
 import os
+from zipfile import ZipFile
 from tempfile import TemporaryDirectory
 
 from django.test import override_settings
@@ -14,6 +16,9 @@ rootdir = os.path.abspath(os.path.join(__file__, "../../../.."))
 
 class TestIsUrlWhitelisted(TestCase):
 
+    def setUp(self):
+        utils.reset_url_matcher()
+
     def test_url_whitelist_exact(self):
         urls = """http://xyzzy.com
                 http://www.example.com
@@ -39,6 +44,21 @@ class TestIsUrlWhitelisted(TestCase):
         self.assertFalse(is_url_whitelisted("http://youtube.com"))
         self.assertFalse(is_url_whitelisted("http://xyzzy.com/abcdefg"))
 
+    def test_url_whitelist_cached(self):
+        AllowedLinkset.objects.create(name="foo", urls="http://www.example.com\n*.example.org/*")
+        self.assertTrue(is_url_whitelisted("http://www.example.com"))
+        with self.assertNumQueries(0):
+            self.assertTrue(is_url_whitelisted("http://www.example.org/a"))
+            self.assertFalse(is_url_whitelisted("http://youtube.com"))
+
+    def test_url_whitelist_invalidated(self):
+        linkset = AllowedLinkset.objects.create(name="foo", urls="http://www.example.com")
+        self.assertFalse(is_url_whitelisted("http://youtube.com"))
+        linkset.urls += "\nhttp://youtube.com"
+        linkset.save()
+        self.assertTrue(is_url_whitelisted("http://youtube.com"))
+        linkset.delete()
+        self.assertFalse(is_url_whitelisted("http://youtube.com"))
 
 
 class TestFindRootDirectory(TestCase):
@@ -89,11 +109,65 @@ class TestUnzip(TestCase):
                 tempdir,
                 recursive=True,
             )
-            self.assertTrue(os.path.exists(tempdir + "/foo/bar/foo.zip"))
+            # inner zips are unpacked from the outer one, not written to disk
+            self.assertFalse(os.path.exists(tempdir + "/foo/bar/foo.zip"))
             self.assertTrue(os.path.exists(tempdir + "/foo/bar/foobar.txt"))
             self.assertTrue(os.path.exists(tempdir + "/foo/bar/foo"))
             self.assertTrue(os.path.exists(tempdir + "/foo/bar/foo/foo/bar/foobar.txt"))
 
+    def test_unzip_ignore_patterns(self):
+        zip_buff = BytesIO()
+        with ZipFile(zip_buff, "w") as outer:
+            inner_buff = BytesIO()
+            with ZipFile(inner_buff, "w") as inner:
+                inner.writestr("bundle/log.txt", "log")
+                inner.writestr("bundle/assets/big.png", "png")
+            outer.writestr("outer/inner.zip", inner_buff.getvalue())
+            outer.writestr("outer/assets/other.png", "png")
+        with TemporaryDirectory() as tempdir:
+            utils.unzip(zip_buff, tempdir, recursive=True, ignore_patterns=["*/assets/*"])
+            filenames = [
+                os.path.relpath(os.path.join(dirpath, filename), tempdir)
+                for dirpath, dirnames, filenames in os.walk(tempdir)
+                for filename in filenames
+            ]
+        self.assertEqual(filenames, ["outer/inner/bundle/log.txt"])
+
+    def unzip_contents(self, zipfile, workers):
+        with TemporaryDirectory() as tempdir:
+            utils.unzip(zipfile, tempdir, recursive=True, ignore_patterns=["*/assets/*"], workers=workers)
+            contents = {}
+            for dirpath, dirnames, filenames in os.walk(tempdir):
+                for filename in filenames:
+                    with open(os.path.join(dirpath, filename)) as f:
+                        contents[os.path.relpath(os.path.join(dirpath, filename), tempdir)] = f.read()
+            return contents
+
+    def test_parallel_unzip_matches_serial(self):
+        zip_buff = BytesIO()
+        with ZipFile(zip_buff, "w") as outer:
+            for n in range(8):
+                inner_buff = BytesIO()
+                with ZipFile(inner_buff, "w") as inner:
+                    inner.writestr("bundle/topics/article.html", f"article {n}")
+                    inner.writestr("bundle/assets/big.png", "png")
+                outer.writestr(f"outer/inner{n}.zip", inner_buff.getvalue())
+        serial = self.unzip_contents(zip_buff, workers=1)
+        self.assertEqual(len(serial), 8)
+        self.assertEqual(self.unzip_contents(zip_buff, workers=4), serial)
+
+    def test_parallel_unzip_overlapping_in_archive_order(self):
+        zip_buff = BytesIO()
+        with ZipFile(zip_buff, "w") as outer:
+            # both unpack to a/b/same.txt, the last one in the archive wins
+            for n, (name, member) in enumerate([("a.zip", "b/same.txt"), ("a/b.zip", "same.txt")]):
+                inner_buff = BytesIO()
+                with ZipFile(inner_buff, "w") as inner:
+                    inner.writestr(member, f"inner {n}")
+                outer.writestr(name, inner_buff.getvalue())
+        for workers in (1, 4):
+            self.assertEqual(self.unzip_contents(zip_buff, workers), {"a/b/same.txt": "inner 1"})
+
 
 class MiscUtilTets(TestCase):
     @override_settings(SKIP_HTML_FILES=["index.html"])
@@ -0,0 +1,85 @@
+from io import StringIO
+import json
+import os
+from tempfile import TemporaryDirectory
+from zipfile import ZipFile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+import responses
+from test_plus.test import TestCase
+from unittest import mock
+
+from . import utils
+from ..models import Bundle
+from ..models import Log
+
+
+class TestValidateBundle(TestCase):
+    def write_bundle(self, zip_path, articles):
+        with ZipFile(zip_path, "w") as f:
+            f.writestr("bundle/log.txt", "log")
+            f.writestr("bundle/index.html", utils.create_test_html("index", "Index", "summary", "body"))
+            f.writestr("bundle/images/used.png", "png")
+            f.writestr("bundle/images/unused.png", "png")
+            for name, (url_name, body) in articles.items():
+                f.writestr(f"bundle/topics/{name}", utils.create_test_html(url_name, name, "summary", body))
+
+    def validate(self, articles, workers=1):
+        out = StringIO()
+        with TemporaryDirectory() as path:
+            zip_path = os.path.join(path, "bundle.zip")
+            self.write_bundle(zip_path, articles)
+            try:
+                call_command("validate_bundle", zip_path, workers=workers, stdout=out)
+            except CommandError:
+                pass
+        return json.loads(out.getvalue())
+
+    def test_valid(self):
+        report = self.validate({
+            "one.html": ("one", '<img src="../images/used.png"/>'),
+            "two.html": ("two", "two"),
+        })
+        self.assertTrue(report["valid"])
+        self.assertEqual(report["root"], "bundle")
+        self.assertEqual(report["index"]["url_name"], "index")
+        self.assertEqual(report["articles"]["topics/one.html"]["images"], ["images/used.png"])
+        self.assertEqual(report["unused_images"], ["images/unused.png"])
+
+    def test_missing_image(self):
+        report = self.validate({
+            "one.html": ("one", '<img src="../images/used.png"/>'),
+            "two.html": ("two", '<img src="../images/missing.png"/>'),
+        })
+        # process_bundle fails on images it cannot link to
+        self.assertFalse(report["valid"])
+        self.assertEqual(report["problem_count"], 1)
+        self.assertEqual(report["articles"]["topics/two.html"]["missing_images"], ["images/missing.png"])
+
+    def test_problems(self):
+        articles = {
+            "one.html": ("same", "<blink>one</blink>"),
+            "two.html": ("Same", "two"),
+        }
+        report = self.validate(articles)
+        self.assertFalse(report["valid"])
+        self.assertEqual(report["problem_count"], 2)
+        self.assertEqual(report["articles"]["topics/one.html"]["problems"], ['Tag "blink" not in whitelist'])
+        self.assertEqual(report["duplicate_url_names"], {"same": ["topics/one.html", "topics/two.html"]})
+
+        self.assertEqual(self.validate(articles, workers=2)["articles"], report["articles"])
+
+    @responses.activate
+    def test_download(self):
+        with TemporaryDirectory() as path:
+            zip_path = os.path.join(path, "bundle.zip")
+            self.write_bundle(zip_path, {"one.html": ("one", "one")})
+            with open(zip_path, "rb") as f:
+                responses.add(responses.GET, Bundle(easydita_id="uuid").url, body=f.read())
+        out = StringIO()
+        with mock.patch.object(Log.objects, "create") as create_log:
+            call_command("validate_bundle", "uuid", stdout=out)
+        self.assertTrue(json.loads(out.getvalue())["valid"])
+        # nothing is logged to the database
+        create_log.assert_not_called()
@@ -1,8 +1,11 @@
 import re
 import os
 import glob
+import threading
 import time
 from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
 from io import BytesIO
 from urllib.parse import urlencode
 from urllib.parse import urljoin
@@ -229,3 +232,53 @@ def mock_easydita():
         url=re.compile("https://.*.salesforce.com/.*"),
         callback=pass_thru,
     )
+
+
+class FakeBundleServer:
+    """Local HTTP server serving content, with Range support.
+
+    The first `failures` responses are cut off after `fail_after` bytes;
+    `requests` records the Range header of every request.
+    """
+
+    def __init__(self, content, failures=0, fail_after=0, ranges=True):
+        self.content = content
+        self.failures = failures
+        self.fail_after = fail_after
+        self.ranges = ranges
+        self.requests = []
+
+    def __enter__(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests.append(self.headers.get("Range"))
+                match = re.match(r"bytes=(\d+)-$", self.headers.get("Range") or "")
+                start = int(match.group(1)) if match and server.ranges else 0
+                body = server.content[start:]
+                self.send_response(HTTPStatus.PARTIAL_CONTENT if start else HTTPStatus.OK)
+                if start:
+                    self.send_header(
+                        "Content-Range", f"bytes {start}-{len(server.content) - 1}/{len(server.content)}"
+                    )
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if server.failures:
+                    server.failures -= 1
+                    body = body[:server.fail_after]
+                    self.close_connection = True
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/bundle"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
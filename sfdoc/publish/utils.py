@@ -1,12 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
 import fnmatch
 import os
 import logging
+import re
 from urllib.parse import urlparse
 from zipfile import ZipFile
 
 from django.conf import settings
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 
+from sfdoc.publish.bundlefs import local_fs
+from sfdoc.publish.bundlefs import member_path
 from sfdoc.publish.models import AllowedLinkset
+from sfdoc.publish.models import Image
+
+# the file that marks the root directory of an easyDITA bundle
+BUNDLE_ROOT_MARKER = "log.txt"
 
 
 def is_html(filename):
@@ -17,15 +28,62 @@ def is_html(filename):
         return False
 
 
+class UrlMatcher:
+    """Match URLs against a list of fnmatch-style patterns.
+
+    Patterns without wildcards are kept in a set; all the others are
+    translated into one combined regular expression.
+    """
+
+    def __init__(self, patterns):
+        self.exact = set()
+        wildcards = []
+        for pattern in patterns:
+            if any(char in pattern for char in "*?["):
+                wildcards.append(fnmatch.translate(pattern))
+            else:
+                self.exact.add(pattern)
+        self.regex = re.compile("|".join(wildcards)) if wildcards else None
+
+    def match(self, url):
+        if url in self.exact:
+            return True
+        return bool(self.regex and self.regex.match(url))
+
+
+_url_matcher = None
+
+
+def get_url_matcher():
+    """The UrlMatcher for all AllowedLinksets, built once and then cached."""
+    global _url_matcher
+    if _url_matcher is None:
+        _url_matcher = UrlMatcher(AllowedLinkset.all_urls())
+    return _url_matcher
+
+
+def reset_url_matcher():
+    """Forget the cached UrlMatcher so it is rebuilt on next use.
+
+    Saving or deleting an AllowedLinkset only resets the matcher in the
+    process that made the change, so jobs also reset it when they start.
+    """
+    global _url_matcher
+    _url_matcher = None
+
+
+@receiver(post_save, sender=AllowedLinkset)
+@receiver(post_delete, sender=AllowedLinkset)
+def _allowed_linkset_changed(sender, **kwargs):
+    reset_url_matcher()
+
+
 def is_url_whitelisted(url):
     """Determine if a URL is whitelisted."""
     if not urlparse(url).scheme:
         # not an external link, implicitly whitelisted
         return True
-    for wl_item in AllowedLinkset.all_urls():
-        if fnmatch.fnmatch(url, wl_item):
-            return True
-    return False
+    return get_url_matcher().match(url)
 
 
 def skip_html_file(filename):
@@ -44,38 +102,75 @@ def _filternames(open_zipfile, ignore_patterns):
         return list(namelist)
 
 
-# TODO: tests for the ignore_patterns feature
-def unzip(zipfile, path, recursive=False, ignore_patterns=None):
-    """Recursive unzip. EasyDITA bundles consist of double-zipped zipfiles."""
+def unzip(zipfile, path, recursive=False, ignore_patterns=None, workers=None):
+    """Recursive unzip. EasyDITA bundles consist of double-zipped zipfiles.
+
+    With recursive, a zip inside the zip is unpacked straight from its
+    member stream into a directory named after it, without writing the
+    inner zip itself to disk. The inner zips of the outermost zip are
+    unpacked by up to `workers` threads (settings.UNZIP_WORKERS by default)
+    when they do not write to the same directories.
+    """
+    if workers is None:
+        workers = settings.UNZIP_WORKERS
     with ZipFile(zipfile) as f:
         names = _filternames(f, ignore_patterns)
-        f.extractall(path, names)
-    if recursive:
-        for dirpath, dirnames, filenames in os.walk(path):
-            for filename in filenames:
-                root, ext = os.path.splitext(filename)
-                if ext.lower() == ".zip":
-                    unzip(
-                        os.path.join(dirpath, filename),
-                        os.path.join(dirpath, root),
-                        recursive,
-                        ignore_patterns
-                    )
-
-
-def find_bundle_root_directory(origpath):
-    """Find the root directory for a bundle by looking for log.txt in parent and child directories"""
-    matchfile = "log.txt"
-    path = origpath
+        names = set(f.namelist() if names is None else names)
+        inner_zips = []
+        # in archive order, so nested zips are read with forward seeks
+        for info in sorted(f.infolist(), key=lambda info: info.header_offset):
+            if info.filename not in names:
+                continue
+            root, ext = os.path.splitext(info.filename)
+            if recursive and not info.is_dir() and ext.lower() == ".zip":
+                inner_zips.append((info, member_path(path, root)))
+            else:
+                f.extract(info, path)
+
+        def unzip_inner(inner_zip):
+            info, inner_path = inner_zip
+            with f.open(info) as member:
+                unzip(member, inner_path, recursive, ignore_patterns, workers=1)
+
+        if workers > 1 and len(inner_zips) > 1 and not _overlapping(
+            [inner_path for info, inner_path in inner_zips],
+            [member_path(path, name) for name in names],
+        ):
+            # reads from f are serialized by ZipFile, decompressing and
+            # writing the members is not
+            with ThreadPoolExecutor(min(workers, len(inner_zips))) as pool:
+                list(pool.map(unzip_inner, inner_zips))
+        else:
+            for inner_zip in inner_zips:
+                unzip_inner(inner_zip)
+
+
+def _overlapping(dirs, member_paths):
+    """Whether any of dirs is inside another one or holds a member path,
+    so unpacking them in parallel could change which file wins."""
+    if len(set(dirs)) < len(dirs):
+        return True
+    prefixes = tuple(path + os.sep for path in dirs)
+    return any(path.startswith(prefixes) for path in dirs + member_paths)
 
+
+def find_bundle_root_directory(origpath, fs=local_fs):
+    """Find the root directory for a bundle by looking for log.txt in parent and child directories"""
     # look down from origpath away from /
-    for root, dirs, files in os.walk(origpath):
-        if matchfile in files:
+    for root, dirs, files in fs.walk(origpath):
+        if BUNDLE_ROOT_MARKER in files:
             return root
 
+    return find_bundle_root_above(origpath, fs)
+
+
+def find_bundle_root_above(origpath, fs=local_fs):
+    """Find the root directory for a bundle in origpath or its parents"""
+    path = origpath
+
     # look up from origpath toward /
     while len(path) > 1:
-        if os.path.exists(os.path.join(path, "log.txt")):
+        if fs.exists(os.path.join(path, BUNDLE_ROOT_MARKER)):
             return path
         oldpath = path
         path = os.path.dirname(oldpath)
@@ -90,5 +185,19 @@ def bundle_relative_path(bundle_root, path):
     return os.path.relpath(path, bundle_root)
 
 
+def draft_image_urls(docset_id, bundle_root, image_paths, fs=local_fs):
+    """Map bundle-relative paths of the images that exist to their draft URLs.
+
+    Built once per bundle, so that rewriting the links of an article needs
+    no filesystem access. fs can also be a BundleManifest.
+    """
+    image_urls = {}
+    for path in image_paths:
+        if fs.exists(path):
+            relname = bundle_relative_path(bundle_root, path)
+            image_urls[relname] = Image.get_url(docset_id, relname, draft=True)
+    return image_urls
+
+
 logger = logging.getLogger("commands")
 # tools for syncing to S3 were removed after b656c3b4